@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Infinario API, used by the benchmarks.
+
+    python benchmarks/fake_api.py [--port 8080] [--latency 0.005] [--error-rate 0.01] [--retry-rate 0.05]
+
+It answers the endpoints used by the SDK (crm/events, crm/customers, bulk, campaigns/html/get,
+analytics/segmentation-for and analytics/<type>) after `latency` seconds. A request fails with 503 with probability
+`error_rate`; each bulk command is answered with the 'retry' status with probability `retry_rate`.
+
+Every accepted event tracked with the `bench_sent` property (a time.time() timestamp) contributes to the end-to-end
+latencies. GET /_stats returns the request counts and latencies as JSON, DELETE /_stats resets them.
+"""
+
+from __future__ import print_function
+
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class FakeAPI(object):
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_rate = retry_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # headers and body are written separately
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                encoding = self.headers.get('Content-Encoding')
+                if encoding:
+                    body = zlib.decompress(body, 31 if encoding == 'gzip' else zlib.MAX_WBITS)
+                self._reply(*api.respond(self.path.lstrip('/'), json.loads(body.decode('utf-8'))))
+
+            def do_GET(self):
+                if self.path != '/_stats':
+                    return self._reply(404, {'success': False, 'errors': ['not found']})
+                self._reply(200, api.stats())
+
+            def do_DELETE(self):
+                api.reset()
+                self._reply(200, {'success': True})
+
+            def _reply(self, status, response):
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self.target = 'http://{0}:{1}/'.format(host, self.server.server_port)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}
+            self._events = 0
+            self._latencies = []
+            self._last_received = None
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self._requests), 'events': self._events, 'latencies': list(self._latencies),
+                    'last_received': self._last_received}
+
+    def respond(self, service, message):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._requests[service] = self._requests.get(service, 0) + 1
+            if self._random.random() < self.error_rate:
+                return 503, {'success': False, 'errors': ['injected error']}
+
+            if service == 'bulk':
+                results = []
+                for command in message['commands']:
+                    if self._random.random() < self.retry_rate:
+                        results.append({'status': 'retry'})
+                    else:
+                        self._received(command['name'], command['data'])
+                        results.append({'status': 'ok'})
+                return 200, {'success': True, 'results': results}
+            if service in ('crm/events', 'crm/customers'):
+                self._received(service, message)
+                return 200, {'success': True}
+
+        if service == 'campaigns/html/get':
+            return 200, {'success': True, 'data': '<img src="banner.png" />'}
+        if service == 'analytics/segmentation-for':
+            return 200, {'success': True, 'segment': 'Heavy payer'}
+        if service.startswith('analytics/'):
+            return 200, {'success': True, 'header': ['customer', 'total'],
+                         'rows': [['customer-{0}'.format(i), i] for i in range(100)]}
+        return 404, {'success': False, 'errors': ['unknown service {0}'.format(service)]}
+
+    def _received(self, service, data):
+        now = time.time()
+        self._last_received = now
+        if service != 'crm/events':
+            return
+        self._events += 1
+        sent = data.get('properties', {}).get('bench_sent')
+        if sent is not None:
+            self._latencies.append(now - sent)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 503 response')
+    parser.add_argument('--retry-rate', type=float, default=0.0, help='probability of a retry status of a command')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    fake = FakeAPI(args.host, args.port, args.latency, args.error_rate, args.retry_rate, args.seed)
+    print(fake.target)
+    sys.stdout.flush()
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
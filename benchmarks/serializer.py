@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the per-event CPU cost of encoding buffered commands into bulk requests.
+
+    python benchmarks/serializer.py [--events 100000]
+
+`dicts` is the original path: command dicts are buffered and the whole bulk envelope is encoded with json.dumps
+at flush time. The other rows serialize every command once when it is buffered and assemble the envelope
+from the encoded fragments. All rows include decoding the bulk response.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infinario import ASYNC_BUFFER_MAX_SIZE, SERIALIZERS, _encode_bulk  # noqa: E402
+
+
+def _command(i):
+    return {
+        'customer_ids': {'registered': 'customer-{0}'.format(i % 1000)},
+        'project_id': '12345678-90ab-cdef-1234-567890abcdef',
+        'type': 'purchase',
+        'properties': {'product': 'bottle', 'amount': i % 7, 'price': 12.5, 'tags': ['a', 'b'],
+                       'note': u'\u017elt\u00fd'},
+    }
+
+
+def _response(size):
+    return json.dumps({'success': True, 'results': [{'status': 'ok'}] * size}).encode('utf-8')
+
+
+def bench_dicts(events):
+    response = _response(ASYNC_BUFFER_MAX_SIZE)
+    started = time.process_time()
+    buffer = []
+    for i in range(events):
+        buffer.append({'name': 'crm/events', 'data': _command(i), 'scheduled': 1.0})
+        if len(buffer) == ASYNC_BUFFER_MAX_SIZE:
+            json.dumps({'commands': buffer})
+            json.loads(response.decode('utf-8'))
+            buffer = []
+    return time.process_time() - started
+
+
+def bench_encoded(events, serializer):
+    response = _response(ASYNC_BUFFER_MAX_SIZE)
+    started = time.process_time()
+    buffer = []
+    for i in range(events):
+        buffer.append(serializer.dumps({'name': 'crm/events', 'data': _command(i), 'scheduled': 1.0}))
+        if len(buffer) == ASYNC_BUFFER_MAX_SIZE:
+            _encode_bulk(buffer)
+            serializer.loads(response)
+            buffer = []
+    return time.process_time() - started
+
+
+def bench_baseline(events):
+    # cost of building the command dicts alone, subtracted from all rows
+    started = time.process_time()
+    for i in range(events):
+        {'name': 'crm/events', 'data': _command(i), 'scheduled': 1.0}
+    return time.process_time() - started
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    args = parser.parse_args()
+
+    baseline = bench_baseline(args.events)
+    rows = [('dicts (json.dumps at flush)', bench_dicts(args.events))]
+    for name in ('json', 'ujson', 'orjson'):
+        if name in SERIALIZERS:
+            rows.append(('encoded at enqueue ({0})'.format(name), bench_encoded(args.events, SERIALIZERS[name])))
+
+    for name, seconds in rows:
+        print('{0:<32} {1:7.2f} us/event'.format(name, (seconds - baseline) / args.events * 1e6))
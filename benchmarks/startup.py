@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Time to import infinario and to create a client, each measured in fresh interpreters.
+
+    python benchmarks/startup.py [--runs 20] [--save results.json]
+    python benchmarks/startup.py --compare results.json [--tolerance 0.2]
+
+For every transport, the median over `runs` interpreters is reported of the time `import infinario` takes and
+of the time the Infinario constructor takes, and whether requests was imported. The stand-in target is never
+contacted, as no data is tracked. Saving and comparing the results works as in transports.py.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from transports import ROOT, _commit, compare
+
+# metric -> True if higher is better
+METRICS = {
+    'import_ms': False,
+    'construct_ms': False,
+}
+
+TRANSPORTS = ['NullTransport', 'HTTPClientTransport', 'SynchronousTransport', 'AsynchronousTransport']
+
+SCRIPT = '''
+import json, sys, time
+started = time.time()
+import infinario
+imported = time.time()
+client = infinario.Infinario('t', target='http://127.0.0.1:1/', transport=getattr(infinario, sys.argv[1]))
+constructed = time.time()
+client.close()
+print(json.dumps({'import': imported - started, 'construct': constructed - imported,
+                  'requests_imported': 'requests' in sys.modules}))
+'''
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def bench(transport, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT, transport], cwd=ROOT)
+        samples.append(json.loads(output.decode('utf-8')))
+    return {
+        'import_ms': round(_median([sample['import'] for sample in samples]) * 1e3, 2),
+        'construct_ms': round(_median([sample['construct'] for sample in samples]) * 1e3, 2),
+        'requests_imported': any(sample['requests_imported'] for sample in samples),
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20, help='interpreters started for every transport')
+    parser.add_argument('--transports', help='comma separated names, all by default')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved before')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    if os.environ.get('PYTHONDONTWRITEBYTECODE'):
+        print('PYTHONDONTWRITEBYTECODE is set, import times include compiling the sources')
+    selected = args.transports.split(',') if args.transports else TRANSPORTS
+    results = {}
+    print('{0:<24} {1:>10} {2:>13} {3:>10}'.format('transport', 'import ms', 'construct ms', 'requests'))
+    for name in selected:
+        result = results[name] = bench(name, args.runs)
+        print('{0:<24} {import_ms:>10} {construct_ms:>13} {requests_imported!s:>10}'.format(name, **result))
+
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({
+                'meta': {'python': platform.python_version(), 'commit': _commit(), 'date': time.time(),
+                         'config': {'runs': args.runs}},
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as saved:
+            regressions = compare(results, json.load(saved)['results'], args.tolerance, METRICS)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
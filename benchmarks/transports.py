@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Throughput, latency and memory of the transports against a local stand-in API (see fake_api.py).
+
+    python benchmarks/transports.py [--events 2000] [--latency 0.002] [--retry-rate 0.01] [--save results.json]
+    python benchmarks/transports.py --compare results.json [--tolerance 0.2]
+
+For every transport, `events` events are tracked from one thread and the client is closed. Reported are
+events/sec (from the first track call until everything was delivered), p50/p99 of the time a track call takes
+(enqueue) and of the time until the API received the event (end-to-end), and the peak memory allocated meanwhile,
+measured with tracemalloc in a separate run. The stand-in API runs in a subprocess so that it does not compete
+for the GIL.
+
+Results are saved as JSON together with the Python version and git commit. With `--compare`, the results are checked
+against a saved run and the exit status is 1 if any transport got slower or bigger by more than `tolerance`.
+"""
+
+from __future__ import print_function
+
+import functools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from infinario import AsynchronousTransport, Infinario, SynchronousTransport  # noqa: E402
+
+# metric -> True if higher is better
+METRICS = {
+    'events_per_second': True,
+    'enqueue_p50_us': False,
+    'enqueue_p99_us': False,
+    'e2e_p50_ms': False,
+    'e2e_p99_ms': False,
+    'peak_memory_kib': False,
+}
+
+QUIET = logging.getLogger('infinario.benchmark')
+QUIET.addHandler(logging.NullHandler())
+QUIET.propagate = False
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class _StandIn(object):
+    """
+    The fake API in a subprocess, controlled through its /_stats endpoint.
+    """
+
+    def __init__(self, latency, error_rate, retry_rate):
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_api.py'),
+             '--latency', str(latency), '--error-rate', str(error_rate), '--retry-rate', str(retry_rate),
+             '--seed', '1'],
+            stdout=subprocess.PIPE)
+        self.target = self._process.stdout.readline().decode('ascii').strip()
+
+    def stats(self):
+        return json.loads(urlopen(self.target + '_stats').read().decode('utf-8'))
+
+    def reset(self):
+        urlopen(Request(self.target + '_stats', method='DELETE')).read()
+
+    def close(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+def _transports():
+    transports = [
+        ('sync', SynchronousTransport),
+        ('async', AsynchronousTransport),
+        ('async-4-workers', functools.partial(AsynchronousTransport, workers=4)),
+        ('async-gzip', functools.partial(AsynchronousTransport, compression='gzip')),
+    ]
+    if sys.version_info >= (3, 5):
+        transports.append(('asyncio', None))
+    return transports
+
+
+def _track_all(name, transport, target, events):
+    """
+    Track the events and close the client; returns the enqueue times of the events.
+    """
+    enqueue = []
+    if name == 'asyncio':
+        import asyncio
+        from infinario_asyncio import AsyncInfinario
+
+        async def scenario():
+            client = AsyncInfinario('t', customer='bench', target=target, logger=QUIET)
+            for i in range(events):
+                started = time.time()
+                await client.track('purchase', {'bench_sent': started, 'product': 'bottle', 'amount': i})
+                enqueue.append(time.time() - started)
+            await client.close()
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(scenario())
+        loop.close()
+        return enqueue
+
+    client = Infinario('t', customer='bench', target=target, logger=QUIET, transport=transport)
+    for i in range(events):
+        started = time.time()
+        client.track('purchase', {'bench_sent': started, 'product': 'bottle', 'amount': i})
+        enqueue.append(time.time() - started)
+    client.close()
+    getattr(client._transport, 'join', lambda: None)()
+    return enqueue
+
+
+def bench(stand_in, name, transport, events):
+    stand_in.reset()
+    started = time.time()
+    enqueue = _track_all(name, transport, stand_in.target, events)
+    finished = time.time()
+    stats = stand_in.stats()
+
+    stand_in.reset()
+    tracemalloc.start()
+    _track_all(name, transport, stand_in.target, events)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = stats['latencies']
+    return {
+        'events_per_second': round(stats['events'] / (max(finished, stats['last_received'] or 0) - started), 1),
+        'delivered': stats['events'],
+        'enqueue_p50_us': round(_percentile(enqueue, 0.5) * 1e6, 1),
+        'enqueue_p99_us': round(_percentile(enqueue, 0.99) * 1e6, 1),
+        'e2e_p50_ms': round(_percentile(latencies, 0.5) * 1e3, 2) if latencies else None,
+        'e2e_p99_ms': round(_percentile(latencies, 0.99) * 1e3, 2) if latencies else None,
+        'peak_memory_kib': round(peak / 1024.0, 1),
+    }
+
+
+def compare(results, baseline, tolerance, metrics=METRICS):
+    """
+    Returns the list of regressions of results against the baseline results.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        for metric, higher_is_better in sorted(metrics.items()):
+            value, reference = result.get(metric), baseline.get(name, {}).get(metric)
+            if not value or not reference:
+                continue
+            change = (value - reference) / float(reference)
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append('{0} {1}: {2} -> {3} ({4:+.0%})'.format(name, metric, reference, value, change))
+    return regressions
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds the stand-in API takes per request')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--retry-rate', type=float, default=0.0)
+    parser.add_argument('--transports', help='comma separated names, all by default')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved before')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    selected = args.transports.split(',') if args.transports else None
+    stand_in = _StandIn(args.latency, args.error_rate, args.retry_rate)
+    results = {}
+    try:
+        print('{0:<16} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10}'.format(
+            'transport', 'events/s', 'delivered', 'enq p50us', 'enq p99us', 'e2e p50ms', 'e2e p99ms', 'peak KiB'))
+        for name, transport in _transports():
+            if selected and name not in selected:
+                continue
+            result = results[name] = bench(stand_in, name, transport, args.events)
+            print('{0:<16} {events_per_second:>10} {delivered:>10} {enqueue_p50_us:>10} {enqueue_p99_us:>10} '
+                  '{e2e_p50_ms!s:>10} {e2e_p99_ms!s:>10} {peak_memory_kib:>10}'.format(name, **result))
+    finally:
+        stand_in.close()
+
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({
+                'meta': {'python': platform.python_version(), 'commit': _commit(), 'date': time.time(),
+                         'config': {'events': args.events, 'latency': args.latency, 'error_rate': args.error_rate,
+                                    'retry_rate': args.retry_rate}},
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as saved:
+            regressions = compare(results, json.load(saved)['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
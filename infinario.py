@@ -9,11 +9,26 @@ __licence__ = 'Apache 2.0'
 __copyright__ = 'Copyright 2015 7Segments s r.o.'
 
 
+import bisect
+import codecs
+import collections
+import csv
+import functools
+import itertools
+import io
 import json
+import mmap
+import errno
+import os
+import random
+import struct
 import threading
 import re
-import requests
-from requests.exceptions import ConnectionError, Timeout
+import zlib
+import socket
+import stat
+import tempfile
+import weakref
 import logging
 import time
 
@@ -31,11 +46,92 @@ if sys.version < '3':
 else:
     u = lambda string: string
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_replace_file = getattr(os, 'replace', os.rename)
+_monotonic = getattr(time, 'monotonic', time.time)
+_register_at_fork = getattr(os, 'register_at_fork', None)
+
+
+def _requests():
+    """
+    The requests module, imported on first use so that importing infinario stays fast.
+    """
+    import requests
+    return requests
+
+
+def _uses_requests(transport):
+    """
+    Whether a transport class, possibly wrapped in functools.partial, is created with a requests.Session.
+    """
+    uses_requests = getattr(getattr(transport, 'func', transport), 'uses_requests', True)
+    if uses_requests is None:
+        # RecordingTransport, which uses the session only for the transport it wraps
+        return _uses_requests(getattr(transport, 'keywords', {}).get('transport', SynchronousTransport))
+    return uses_requests
+
+
+def _http_client():
+    try:
+        import http.client as http_client
+    except ImportError:
+        import httplib as http_client
+    return http_client
+
 
 DEFAULT_TARGET = 'https://api.infinario.com/'
 DEFAULT_LOGGER = logging.getLogger(__name__)
 ASYNC_BUFFER_MAX_SIZE = 50  # number of customer updates and events before flushing
 ASYNC_BUFFER_TIMEOUT = 1  # max seconds before buffer is flushed
+ASYNC_BULK_MAX_BYTES = 1024 * 1024  # max encoded size of commands in one bulk request
+ASYNC_BUFFER_CAPACITY = 100000  # max number of buffered commands
+ASYNC_WORKERS = 1  # number of threads sending bulks
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024  # bytes written to a spool segment file before starting a new one
+SPOOL_FSYNC_INTERVAL = 0.1  # max seconds between fsyncs of the spool
+IMPORT_BULK_SIZE = 100  # commands in one bulk request of BulkImporter
+IMPORT_CONNECTIONS = 4  # parallel connections of BulkImporter
+IMPORT_MAX_ATTEMPTS = 8  # attempts to send a bulk of imported commands before giving up
+IMPORT_RETRY_DELAY = 0.5  # seconds before the first retry of an import, doubled with every attempt
+IMPORT_CHECKPOINT_INTERVAL = 1  # min seconds between saving the import checkpoint
+CACHE_MAX_SIZE = 10000  # number of results kept by ResultCache
+CACHE_TTL = 60  # seconds a result of ResultCache is fresh
+COMPRESSION_THRESHOLD = 1024  # min bytes of a request body to compress it
+COMPRESSION_LEVEL = 6
+INTERACTIVE_POOL_SIZE = 10  # keep-alive connections of AsynchronousTransport for requests with a response
+PREWARM_TIMEOUT = 5  # max seconds of a request opening a connection in advance
+SEGMENTS_WORKERS = 10  # max number of concurrent requests of get_segments
+RECORDING_CHUNK_SIZE = 64 * 1024  # bytes of records of a RecordingTransport kept in memory before writing them
+REPLAY_CONCURRENCY = 4  # max number of calls made at the same time by Replayer
+SIDECAR_SOCKET = 'infinario-sidecar.sock'  # name of the Unix socket of the SidecarCollector in the user's runtime dir
+SIDECAR_BULK_SIZE = 500  # max number of commands in a bulk request of the SidecarCollector
+SIDECAR_MAX_DATAGRAM = 256 * 1024  # max size of an encoded command handed over to the SidecarCollector
+SIDECAR_RECEIVE_BUFFER = 4 * 1024 * 1024  # requested size of the socket buffer of the SidecarCollector
+SIDECAR_POLL_INTERVAL = 0.5  # seconds between checks whether the SidecarCollector was stopped
+SIDECAR_SEND_TIMEOUT = 0.1  # max seconds to wait for room in the socket of the SidecarCollector
+PRIORITY_HIGH = 'high'  # priority classes of events, see TrackingPolicy
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+POLICY_SHED_AT = {PRIORITY_LOW: 0.5, PRIORITY_NORMAL: 0.9, PRIORITY_HIGH: None}  # buffer fill dropping the priority
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes of a streamed analysis export read at once
+EXPORT_BATCH_SIZE = 10000  # rows in a column batch of a streamed analysis export
+RETRY_MAX_ATTEMPTS = 10  # attempts to send a buffered command before giving up
+RETRY_BASE_DELAY = 0.5  # seconds before the first retry, doubled with every attempt
+RETRY_MAX_DELAY = 60  # max seconds between retries
+CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive failed requests opening the circuit breaker
+CIRCUIT_RESET_TIMEOUT = 10  # seconds before a request is let through an open circuit breaker
+METRICS_BUCKETS = {  # upper bounds of histogram buckets by the suffix of the metric name
+    'seconds': (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'bytes': (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+    'count': (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+}
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
 
 
 class InvalidRequest(Exception):
@@ -63,6 +159,364 @@ class ErrorHandler(object):
             raise exception_cls(error_message)
 
 
+class Serializer(object):
+    """
+    Serializer encodes messages to JSON bytes and decodes responses, see DEFAULT_SERIALIZER.
+    """
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return 'Serializer({0!r})'.format(self.name)
+
+
+def _load_serializers():
+    encoder = json.JSONEncoder(separators=(',', ':'))  # json.dumps would create an encoder on every call
+    serializers = {'json': Serializer('json', lambda obj: encoder.encode(obj).encode('utf-8'),
+                                      lambda data: json.loads(data.decode('utf-8')))}
+    try:
+        import ujson
+        serializers['ujson'] = Serializer('ujson', lambda obj: ujson.dumps(obj).encode('utf-8'), ujson.loads)
+    except ImportError:
+        pass
+    try:
+        import orjson
+        serializers['orjson'] = Serializer('orjson', lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                                           orjson.loads)
+    except ImportError:
+        pass
+    return serializers
+
+
+SERIALIZERS = _load_serializers()  # available serializers by name
+DEFAULT_SERIALIZER = SERIALIZERS.get('orjson') or SERIALIZERS.get('ujson') or SERIALIZERS['json']
+
+
+def _encode_bulk(encoded_commands):
+    # the bulk envelope is assembled from commands serialized at enqueue time instead of encoding them again
+    return b'{"commands":[' + b','.join(encoded_commands) + b']}'
+
+
+class RetryPolicy(object):
+    """
+    Retries of buffered commands which the API asked to retry or which could not be sent.
+
+    Before the n-th retry, a command waits for a random delay between half and all of `base_delay * 2 ** (n - 1)`
+     seconds (at most `max_delay`). After `max_attempts` attempts, or once a command is older than `max_age` seconds,
+     it is given up and passed to `dead_letter(commands, reason, errors)`, which logs an error by default.
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 max_age=None, dead_letter=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        if dead_letter is not None:
+            self.dead_letter = dead_letter
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.random() * delay / 2
+
+    def exhausted(self, attempts, age):
+        return attempts >= self.max_attempts or (self.max_age is not None and age > self.max_age)
+
+    @staticmethod
+    def dead_letter(commands, reason, errors):
+        errors.handle(u('Infinario API bulk gave up on {0} commands ({1})').format(len(commands), reason),
+                      ServiceUnavailable, no_raise=True)
+
+
+def _bulk_statuses(items, response):
+    """
+    The (item, status, errors) of every item of a bulk request in order, by the results in the `response`;
+     None if the request failed or the response has no results. Items without a result are to be retried.
+    """
+    results = response.get('results') if isinstance(response, dict) else None
+    if not isinstance(results, list):
+        return None
+    statuses = []
+    for i, item in enumerate(items):
+        result = results[i] if i < len(results) else {'status': 'retry'}
+        if not isinstance(result, dict):
+            result = {}
+        statuses.append((item, result.get('status', 'missing'), result.get('errors', [])))
+    return statuses
+
+
+def _sort_bulk(items, response):
+    """
+    Sort the items of a bulk request into (ok, retry, failed) by the `response`, see _bulk_statuses, where failed
+     are (item, status, errors); None if the request failed.
+    """
+    statuses = _bulk_statuses(items, response)
+    if statuses is None:
+        return None
+    ok, retry, failed = [], [], []
+    for item, status, errors in statuses:
+        if status == 'ok':
+            ok.append(item)
+        elif status == 'retry':
+            retry.append(item)
+        else:
+            failed.append((item, status, errors))
+    return ok, retry, failed
+
+
+def _bulk_failure(status, errors):
+    return u('Infinario API bulk command failed with status {0}, errors: {1}').format(status, str(errors))
+
+
+def _apply_retry_policy(policy, entries, now):
+    """
+    Count another attempt of buffered commands and split them into (retried, exhausted, due), where due is
+     the time before which the retried commands are not sent again.
+    """
+    retried, exhausted = [], []
+    for entry in entries:
+        entry.attempts += 1
+        if policy.exhausted(entry.attempts, now - entry.created):
+            exhausted.append(entry)
+        else:
+            retried.append(entry)
+    due = now + policy.delay(max(entry.attempts for entry in retried)) if retried else None
+    return retried, exhausted, due
+
+
+def _dead_letter(policy, commands, reason, errors):
+    try:
+        policy.dead_letter(commands, reason, errors)
+    except Exception as e:
+        errors.handle(u('Infinario dead letter handler failed: {0!r}').format(e), ServiceUnavailable, no_raise=True)
+
+
+class CircuitBreaker(object):
+    """
+    Makes requests fail fast while the API is down.
+
+    After `failure_threshold` consecutive requests failing to connect or answered with 503/504, the circuit opens
+     and requests fail immediately with ServiceUnavailable. After `reset_timeout` seconds, one trial request is let
+     through; its success closes the circuit again. By default, all transports of the same target share one breaker.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        _fork_aware[id(self)] = self
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        CircuitBreaker._shared_lock = threading.Lock()
+
+    @classmethod
+    def for_target(cls, target):
+        with cls._shared_lock:
+            if target not in cls._shared:
+                cls._shared[target] = cls()
+            return cls._shared[target]
+
+    @property
+    def open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is not None and _monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            if self._opened_at is not None:
+                self._opened_at = _monotonic()  # half-open, the next trial comes after another reset_timeout
+            return True
+
+    def record_success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                self._failures = 0
+                self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold and self._opened_at is None:
+                self._opened_at = _monotonic()
+
+    def reset(self):
+        self.record_success()
+
+
+class _Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets, cumulative = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Metrics(object):
+    """
+    Counters, histograms and gauges of a client and its transport, see the `metrics` argument of Infinario.
+
+    Nothing is measured unless a Metrics instance is passed. `snapshot()` returns all values for exporting them
+     to a monitoring system; histogram buckets are cumulative (upper bound, count) pairs as in Prometheus.
+    `on_request_start(service, body_size)` and `on_request_end(service, status, seconds)` are called around every
+     HTTP request; status is the HTTP status code, or None if no response was received.
+    """
+
+    def __init__(self, on_request_start=None, on_request_end=None):
+        self.on_request_start = on_request_start
+        self.on_request_end = on_request_end
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+        self._gauges = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, value):
+        """
+        Record a value in histogram `name`; buckets are chosen by the suffix of the name (_seconds, _bytes).
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = _Histogram(METRICS_BUCKETS.get(name.rsplit('_', 1)[-1],
+                                                                                    METRICS_BUCKETS['count']))
+            histogram.observe(value)
+
+    def gauge(self, name, read):
+        """
+        Register a callable returning the current value of gauge `name` when a snapshot is taken.
+        """
+        self._gauges[name] = read
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((name, histogram.snapshot()) for name, histogram in self._histograms.items())
+        gauges = dict((name, read()) for name, read in self._gauges.items())
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def request_started(self, service, size):
+        self.increment('requests')
+        self.observe('request_bytes', size)
+        if self.on_request_start is not None:
+            self.on_request_start(service, size)
+        return _monotonic()
+
+    def request_finished(self, service, status, started):
+        seconds = _monotonic() - started
+        self.observe('request_seconds', seconds)
+        if status is None or status >= 400:
+            self.increment('request_errors')
+        if self.on_request_end is not None:
+            self.on_request_end(service, status, seconds)
+
+
+_fork_aware = weakref.WeakValueDictionary()  # by id, WeakSet is missing in Python 2.6
+
+
+def _after_fork_in_child():
+    for instance in list(_fork_aware.values()):
+        instance._after_fork()
+
+
+if _register_at_fork is not None:
+    _register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _reset_connection_pools(session):
+    """
+    Forget the connections of a session inherited from the parent process, without closing them under the parent.
+    """
+    for adapter in session.adapters.values():
+        if isinstance(adapter, _requests().adapters.HTTPAdapter):
+            adapter.init_poolmanager(adapter._pool_connections, adapter._pool_maxsize, block=adapter._pool_block)
+            adapter.proxy_manager = {}
+
+
+def _compress(body, compression, threshold):
+    """
+    Compress a request body with gzip or deflate if it is at least `threshold` bytes long;
+    returns the body and its Content-Encoding (None if not compressed).
+    """
+    if compression is None or len(body) < threshold:
+        return body, None
+    if compression not in ('gzip', 'deflate'):
+        raise ValueError('Unknown compression {0!r}'.format(compression))
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31 if compression == 'gzip' else zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush(), compression
+
+
+def _handle_response(errors, response, no_raise=False, serializer=None):
+    """
+    Evaluate an API response the same way for all transports; returns the decoded JSON on success.
+    """
+    if response.status_code == 401:
+        return errors.handle(
+            u('Infinario API authentication failure'),
+            AuthenticationError, no_raise=no_raise)
+
+    try:
+        json_response = (serializer or DEFAULT_SERIALIZER).loads(response.content)
+    except (TypeError, ValueError):
+        json_response = {}  # not a JSON body, e.g. an error page of a proxy
+    if not isinstance(json_response, dict):
+        json_response = {}
+
+    if json_response.get('success', False):
+        return json_response
+
+    error_messages = json_response.get('errors', None) or response.text
+
+    if response.status_code in (503, 504):
+        return errors.handle(
+            u('Infinario API is currently unavailable or under too much load: {0}').format(error_messages),
+            ServiceUnavailable, no_raise=no_raise)
+
+    return errors.handle(
+        u('Infinario API request failed with errors: {0}').format(error_messages),
+        InvalidRequest, no_raise=no_raise)
+
+
+class _Response(object):
+    __slots__ = ('status_code', 'content')
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+
 class NullTransport(object):
     """
     NullTransport will make no requests.
@@ -70,12 +524,17 @@ class NullTransport(object):
     It is useful for disabling tracking in the Infinario constructor.
     """
 
+    uses_requests = False  # the Infinario constructor does not create a requests.Session for it
+
     def __init__(self, *_args, **_kwargs):
         pass
 
     def send_and_receive(self, service, message, no_raise=False, timeout=None):
         pass
 
+    def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        pass
+
     def send_and_ignore(self, service, message):
         pass
 
@@ -85,169 +544,1487 @@ class SynchronousTransport(object):
     SynchronousTransport is a simple synchronous transport using request.Session.
 
     Infinario methods identify, track, update and get_html will block for the whole time of a request.
+    Messages are encoded and responses decoded by the `serializer`, DEFAULT_SERIALIZER if not given.
+    With `compression` ('gzip' or 'deflate'), request bodies of at least `compression_threshold` bytes are compressed.
+    Requests fail fast while the `circuit_breaker` is open, by default the CircuitBreaker shared by all transports
+     of the target; pass False to disable it.
+    Requests are measured in `metrics` if given, see class Metrics.
+    The transport can be used in processes forked after it was created; the connections of the parent are not reused.
     """
 
-    def __init__(self, target, errors, session=None):
+    def __init__(self, target, errors, session=None, serializer=None,
+                 compression=None, compression_threshold=COMPRESSION_THRESHOLD, circuit_breaker=None, metrics=None):
+        if compression not in (None, 'gzip', 'deflate'):
+            raise ValueError('Unknown compression {0!r}'.format(compression))
         self._errors = errors
+        self._circuit_breaker = CircuitBreaker.for_target(target) if circuit_breaker is None else circuit_breaker
         self._target = target
-        self._session = session or requests.Session()
+        self._session = session or _requests().Session()
+        self._serializer = serializer or DEFAULT_SERIALIZER
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._metrics = metrics
+        _fork_aware[id(self)] = self
+
+    def _after_fork(self):
+        _reset_connection_pools(self._session)
 
     def _send(self, service, message, no_raise=False, timeout=None):
+        return self._post(service, self._serializer.dumps(message), no_raise=no_raise, timeout=timeout)
+
+    def _post(self, service, body, no_raise=False, timeout=None, stream=False):
+        headers = {'Content-type': 'application/json'}
+        body, encoding = _compress(body, self._compression, self._compression_threshold)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        breaker, metrics = self._circuit_breaker, self._metrics
+        if breaker and not breaker.allow():
+            if metrics is not None:
+                metrics.increment('requests_rejected')
+            return self._errors.handle(
+                u('Infinario API at {0} is unavailable, request to {1} not sent').format(self._target, service),
+                ServiceUnavailable, no_raise=no_raise)
+        if metrics is not None:
+            started, status = metrics.request_started(service, len(body)), None
         try:
             response = self._session.post(
                 u('{0}{1}').format(self._target, service),
-                data=json.dumps(message),
-                headers={'Content-type': 'application/json'},
+                data=body,
+                headers=headers,
                 timeout=timeout,
+                stream=stream,
             )
-        except ConnectionError:
+            if metrics is not None:
+                status = response.status_code
+        except _requests().ConnectionError:
+            if breaker:
+                breaker.record_failure()
             return self._errors.handle(
                 u('Failed connecting to Infinario API at the given target URL {0}').format(self._target),
                 ServiceUnavailable, no_raise=no_raise)
-        except Timeout:
+        except _requests().Timeout:
             return self._errors.handle(
                 u('Infinario request to {0} failed to complete within timeout {1}').format(service, timeout),
                 ServiceUnavailable, no_raise=no_raise)
+        finally:
+            if metrics is not None:
+                metrics.request_finished(service, status, started)
 
-        if response.status_code == 401:
-            return self._errors.handle(
-                u('Infinario API authentication failure'),
-                AuthenticationError, no_raise=no_raise)
+        if breaker:
+            if response.status_code in (503, 504):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+        if stream and response.status_code == 200:
+            return response
+        return _handle_response(self._errors, response, no_raise=no_raise, serializer=self._serializer)
 
-        json_response = response.json()
+    def send_and_receive(self, service, message, no_raise=False, timeout=None):
+        # always non-silent, as the result is used
+        return self._send(service, message, no_raise=no_raise, timeout=timeout)
 
-        if json_response.get('success', False):
-            return json_response
+    def send_encoded(self, service, body, no_raise=False, timeout=None):
+        """
+        Send a message already encoded by the serializer and return the response.
+        """
+        return self._post(service, body, no_raise=no_raise, timeout=timeout)
+
+    def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Send a message and return an iterator of the chunks of the response body as they are downloaded,
+         None if the request failed.
+        """
+        response = self._post(service, self._serializer.dumps(message), no_raise=no_raise, timeout=timeout,
+                              stream=True)
+        if response is None or isinstance(response, dict):
+            return None
+        return self._iter_chunks(response, chunk_size)
+
+    @staticmethod
+    def _iter_chunks(response, chunk_size):
+        try:
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+        finally:
+            response.close()
+
+    def send_and_ignore(self, service, message):
+        self._send(service, message)
+
+    def prewarm(self, connections=1):
+        """
+        Open `connections` keep-alive connections (including the TLS handshake) before they are needed.
+        """
+        def connect():
+            try:
+                self._session.head(self._target, timeout=PREWARM_TIMEOUT).close()
+            except _requests().RequestException:
+                pass
+
+        threads = [threading.Thread(target=connect) for _ in range(connections)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class _StreamedResponse(object):
+    __slots__ = ('status_code', '_transport', '_connection', '_raw')
+
+    def __init__(self, transport, connection, raw):
+        self.status_code = raw.status
+        self._transport = transport
+        self._connection = connection
+        self._raw = raw
+
+    def iter_chunks(self, chunk_size):
+        complete = False
+        try:
+            while True:
+                chunk = self._raw.read(chunk_size)
+                if not chunk:
+                    complete = True
+                    return
+                yield chunk
+        finally:
+            self._transport._release(self._connection, complete and not self._raw.will_close)
 
-        errors = json_response.get('errors', None) or response.text
 
-        if response.status_code in (503, 504):
+class HTTPClientTransport(object):
+    """
+    HTTPClientTransport is a synchronous transport using only the standard library (http.client), for minimal
+     environments and fast startup; unlike SynchronousTransport, it never imports requests.
+
+    It keeps up to `pool_size` keep-alive connections open and otherwise behaves as SynchronousTransport.
+     The `secret` is sent with every request. Proxies and client certificates are not supported.
+    """
+
+    uses_requests = False  # the Infinario constructor passes the secret instead of a requests.Session
+
+    def __init__(self, target, errors, secret=None, serializer=None, compression=None,
+                 compression_threshold=COMPRESSION_THRESHOLD, circuit_breaker=None, metrics=None,
+                 pool_size=INTERACTIVE_POOL_SIZE):
+        if compression not in (None, 'gzip', 'deflate'):
+            raise ValueError('Unknown compression {0!r}'.format(compression))
+        try:
+            from urllib.parse import urlsplit
+        except ImportError:
+            from urlparse import urlsplit
+
+        parts = urlsplit(target)
+        self._secure = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port
+        self._prefix = parts.path or '/'
+        self._errors = errors
+        self._circuit_breaker = CircuitBreaker.for_target(target) if circuit_breaker is None else circuit_breaker
+        self._target = target
+        self._headers = {'Content-type': 'application/json', 'Connection': 'keep-alive'}
+        if secret:
+            self._headers['X-Infinario-Secret'] = secret
+        self._serializer = serializer or DEFAULT_SERIALIZER
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._metrics = metrics
+        self._pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+        _fork_aware[id(self)] = self
+
+    def _after_fork(self):
+        # the connections are shared with the parent process, so they are dropped without closing them
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _send(self, service, message, no_raise=False, timeout=None):
+        return self._post(service, self._serializer.dumps(message), no_raise=no_raise, timeout=timeout)
+
+    def _post(self, service, body, no_raise=False, timeout=None, stream=False):
+        headers = self._headers
+        body, encoding = _compress(body, self._compression, self._compression_threshold)
+        if encoding is not None:
+            headers = dict(headers, **{'Content-Encoding': encoding})
+        breaker, metrics = self._circuit_breaker, self._metrics
+        if breaker and not breaker.allow():
+            if metrics is not None:
+                metrics.increment('requests_rejected')
             return self._errors.handle(
-                u('Infinario API is currently unavailable or under too much load: {0}').format(errors),
+                u('Infinario API at {0} is unavailable, request to {1} not sent').format(self._target, service),
                 ServiceUnavailable, no_raise=no_raise)
-
-        return self._errors.handle(
-            u('Infinario API request failed with errors: {0}').format(errors),
-            InvalidRequest, no_raise=no_raise)
+        if metrics is not None:
+            started, status = metrics.request_started(service, len(body)), None
+        try:
+            response = self._exchange(self._prefix + service, body, headers, timeout, stream)
+            if metrics is not None:
+                status = response.status_code
+        except socket.timeout:
+            return self._errors.handle(
+                u('Infinario request to {0} failed to complete within timeout {1}').format(service, timeout),
+                ServiceUnavailable, no_raise=no_raise)
+        except (_http_client().HTTPException, socket.error):
+            if breaker:
+                breaker.record_failure()
+            return self._errors.handle(
+                u('Failed connecting to Infinario API at the given target URL {0}').format(self._target),
+                ServiceUnavailable, no_raise=no_raise)
+        finally:
+            if metrics is not None:
+                metrics.request_finished(service, status, started)
+
+        if breaker:
+            if response.status_code in (503, 504):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+        if isinstance(response, _StreamedResponse):
+            return response
+        return _handle_response(self._errors, response, no_raise=no_raise, serializer=self._serializer)
+
+    def _exchange(self, path, body, headers, timeout, stream):
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = self._connection(timeout)
+            elif connection.sock is not None:
+                connection.sock.settimeout(timeout)
+
+            try:
+                connection.request('POST', path, body, headers)
+                raw = connection.getresponse()
+                if stream and raw.status == 200:
+                    return _StreamedResponse(self, connection, raw)
+                content = raw.read()
+            except BaseException as e:
+                connection.close()
+                failed = isinstance(e, (_http_client().HTTPException, socket.error))
+                if reused and failed and not isinstance(e, socket.timeout):
+                    continue  # keep-alive connection was closed by the server in the meantime, try another one
+                raise
+            self._release(connection, not raw.will_close)
+            return _Response(raw.status, content)
+
+    def _connection(self, timeout):
+        # http.client is imported only when the first connection is opened
+        http_client = _http_client()
+        connection_class = http_client.HTTPSConnection if self._secure else http_client.HTTPConnection
+        return connection_class(self._host, self._port, timeout=timeout)
+
+    def _release(self, connection, reusable):
+        with self._lock:
+            if reusable and len(self._idle) < self._pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
 
     def send_and_receive(self, service, message, no_raise=False, timeout=None):
         # always non-silent, as the result is used
         return self._send(service, message, no_raise=no_raise, timeout=timeout)
 
+    def send_encoded(self, service, body, no_raise=False, timeout=None):
+        """
+        Send a message already encoded by the serializer and return the response.
+        """
+        return self._post(service, body, no_raise=no_raise, timeout=timeout)
+
+    def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Send a message and return an iterator of the chunks of the response body as they are downloaded,
+         None if the request failed.
+        """
+        response = self._post(service, self._serializer.dumps(message), no_raise=no_raise, timeout=timeout,
+                              stream=True)
+        if not isinstance(response, _StreamedResponse):
+            return None
+        return response.iter_chunks(chunk_size)
+
     def send_and_ignore(self, service, message):
         self._send(service, message)
 
+    def prewarm(self, connections=1):
+        """
+        Open `connections` keep-alive connections (including the TLS handshake) before they are needed.
+        """
+        def connect():
+            connection = self._connection(PREWARM_TIMEOUT)
+            try:
+                connection.connect()
+            except (_http_client().HTTPException, socket.error):
+                return connection.close()
+            self._release(connection, True)
+
+        threads = [threading.Thread(target=connect) for _ in range(connections)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class _DiskSpool(object):
+    """
+    Append-only on-disk log of buffered commands, so that unacknowledged commands survive a crash or restart.
+
+    Every command is appended to the active segment file as a (sequence number, length, JSON) record; sequence
+     numbers of acknowledged commands go to the segment's `.ack` file. Segments with all commands acknowledged
+     are deleted. Records are written straight to the OS, fsync is batched every `fsync_interval` seconds.
+    Delivery is at-least-once: a command may be sent again if its acknowledgement was not persisted.
+    """
+
+    _RECORD = struct.Struct('>QI')
+    _ACK = struct.Struct('>Q')
+
+    def __init__(self, directory, segment_size=SPOOL_SEGMENT_SIZE, fsync_interval=SPOOL_FSYNC_INTERVAL):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._first_seqs = []  # first sequence number of each live segment, ascending
+        self._segments = {}  # first sequence number -> segment number, set of pending sequence numbers, ack fd
+        self._next_seq = 0
+        self._next_segment = 0
+        self._active = None
+        self._active_fd = None
+        self._active_size = 0
+        self._dirty = False
+        self._closed = False
+        self._syncer = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def recover(self):
+        """
+        Load the unacknowledged commands of previous runs; returns a list of (sequence number, encoded command).
+        """
+        recovered = []
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self._directory) if name.endswith('.log'))
+
+        for number in numbers:
+            acked = set()
+            ack_path = self._path(number, '.ack')
+            if os.path.exists(ack_path):
+                with open(ack_path, 'rb') as ack_file:
+                    acks = ack_file.read()
+                acked.update(self._ACK.unpack_from(acks, i)[0]
+                             for i in range(0, len(acks) - self._ACK.size + 1, self._ACK.size))
+
+            pending = set()
+            for seq, payload in self._read_segment(number):
+                self._next_seq = max(self._next_seq, seq + 1)
+                if seq not in acked:
+                    pending.add(seq)
+                    recovered.append((seq, payload))
+
+            self._next_segment = number + 1
+            if pending:
+                self._add_segment(number, min(pending), pending)
+            else:
+                self._remove_files(number)
+
+        return recovered
+
+    def append(self, payload):
+        """
+        Write an encoded command to the spool and return its sequence number.
+        """
+        with self._lock:
+            if self._active is None or self._active_size >= self._segment_size:
+                self._rotate()
+            seq = self._next_seq
+            self._next_seq += 1
+            os.write(self._active_fd, self._RECORD.pack(seq, len(payload)) + payload)
+            self._active_size += self._RECORD.size + len(payload)
+            self._segments[self._active][1].add(seq)
+            self._dirty = True
+        return seq
+
+    def ack(self, seqs):
+        """
+        Mark commands as delivered (or permanently failed) and delete segments that are no longer needed.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            for seq in seqs:
+                first = self._first_seqs[bisect.bisect_right(self._first_seqs, seq) - 1]
+                number, pending, ack_fd = self._segments[first]
+                pending.discard(seq)
+                if not pending and first != self._active:
+                    self._drop_segment(first)
+                else:
+                    os.write(ack_fd, self._ACK.pack(seq))
+
+    def sync(self):
+        with self._lock:
+            if self._dirty and self._active_fd is not None:
+                os.fsync(self._active_fd)
+                self._dirty = False
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._closed = True
+            for number, pending, ack_fd in self._segments.values():
+                os.close(ack_fd)
+            if self._active_fd is not None:
+                os.close(self._active_fd)
+            self._segments, self._first_seqs, self._active, self._active_fd = {}, [], None, None
+
+    def _rotate(self):
+        if self._closed:
+            raise ValueError('The spool is already closed')
+        if self._active is not None:
+            os.fsync(self._active_fd)
+            os.close(self._active_fd)
+            if not self._segments[self._active][1]:
+                self._drop_segment(self._active)
+        number = self._next_segment
+        self._next_segment += 1
+        self._active_fd = os.open(self._path(number, '.log'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._active_size = 0
+        self._active = self._next_seq
+        self._add_segment(number, self._active, set())
+
+        if self._syncer is None:
+            self._syncer = threading.Thread(target=self._run_syncer)
+            self._syncer.daemon = True
+            self._syncer.start()
+
+    def _run_syncer(self):
+        while not self._closed:
+            time.sleep(self._fsync_interval)
+            self.sync()
+
+    def _add_segment(self, number, first, pending):
+        ack_fd = os.open(self._path(number, '.ack'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._segments[first] = (number, pending, ack_fd)
+        bisect.insort(self._first_seqs, first)
+
+    def _drop_segment(self, first):
+        number, _, ack_fd = self._segments.pop(first)
+        self._first_seqs.remove(first)
+        os.close(ack_fd)
+        self._remove_files(number)
+
+    def _remove_files(self, number):
+        for extension in ('.log', '.ack'):
+            try:
+                os.remove(self._path(number, extension))
+            except OSError:
+                pass
+
+    def _read_segment(self, number):
+        with open(self._path(number, '.log'), 'rb') as segment_file:
+            size = os.fstat(segment_file.fileno()).st_size
+            if size == 0:
+                return
+            data = mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset + self._RECORD.size <= size:
+                    seq, length = self._RECORD.unpack_from(data, offset)
+                    offset += self._RECORD.size
+                    if offset + length > size:
+                        break  # torn write of the last record
+                    yield seq, data[offset:offset + length]
+                    offset += length
+            finally:
+                data.close()
+
+    def _path(self, number, extension):
+        return os.path.join(self._directory, '{0:016d}{1}'.format(number, extension))
+
+
+class FixedBatching(object):
+    """
+    Batching of AsynchronousTransport with a constant bulk size and linger time (the default).
+    """
+
+    def __init__(self, batch_size=ASYNC_BUFFER_MAX_SIZE, linger=ASYNC_BUFFER_TIMEOUT):
+        self.batch_size = batch_size  # max commands in one bulk
+        self.linger = linger  # max seconds a command waits in the buffer before a bulk is sent
+
+    def observe(self, rtt, sent, retried, depth):
+        pass
+
+    def settings(self):
+        return {'batch_size': self.batch_size, 'linger': self.linger}
+
+
+class AdaptiveBatching(FixedBatching):
+    """
+    Batching of AsynchronousTransport tuning the bulk size and linger time at runtime, within the given bounds.
+
+    After every bulk request, AsynchronousTransport reports the round-trip time, the number of sent and retried
+     commands and the number of commands still buffered:
+     - retried or failed commands halve the bulk size and double the linger time to relieve the API,
+     - a backlog of at least one full bulk doubles the bulk size,
+     - otherwise the linger time follows half of the average round-trip time, as commands would queue behind
+       the request in flight anyway, and the bulk size slowly shrinks back towards the backlog.
+    """
+
+    def __init__(self, min_batch_size=1, max_batch_size=500, min_linger=0.0, max_linger=ASYNC_BUFFER_TIMEOUT):
+        if not 1 <= min_batch_size <= max_batch_size or not 0 <= min_linger <= max_linger:
+            raise ValueError('Invalid bounds of AdaptiveBatching')
+        super(AdaptiveBatching, self).__init__(max(min_batch_size, min(ASYNC_BUFFER_MAX_SIZE, max_batch_size)),
+                                               min_linger)
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_linger = min_linger
+        self.max_linger = max_linger
+        self.rtt = None  # moving average of the bulk round-trip time
+
+    def observe(self, rtt, sent, retried, depth):
+        """
+        Called by AsynchronousTransport under its lock after every bulk request; `rtt` is None if it failed.
+        """
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt * 0.8 + rtt * 0.2
+
+        if rtt is None or retried > 0:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.linger = min(self.max_linger, max(self.linger * 2, self.rtt or 0, 0.01))
+        elif depth >= self.batch_size:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+        else:
+            self.linger = min(self.max_linger, max(self.min_linger, (self.rtt or 0) / 2))
+            self.batch_size = max(self.min_batch_size, depth, self.batch_size - max(1, self.batch_size // 10))
+
+    def settings(self):
+        return {'batch_size': self.batch_size, 'linger': self.linger, 'rtt': self.rtt}
+
 
 class _WorkerData(object):
     def __init__(self, **kwargs):
         self.__dict__.update(**kwargs)
 
 
+class _BufferedCommand(object):
+    __slots__ = ('encoded', 'scheduled', 'created', 'seq', 'attempts', 'update')
+
+    def __init__(self, encoded, scheduled, seq=None):
+        self.encoded = encoded  # the command serialized at enqueue time
+        self.scheduled = scheduled
+        self.created = scheduled
+        self.seq = seq  # sequence number in the disk spool
+        self.attempts = 0
+        self.update = None  # customer key of a customer update that can be coalesced
+
+
+class _UpdateCoalescer(object):
+    """
+    Merges the crm/customers commands of a customer waiting in a buffer into the first of them, the properties
+     of later updates win. Used under the lock of the buffer.
+    """
+
+    def __init__(self, serializer):
+        self._serializer = serializer
+        self._pending = {}  # (project_id, ids) -> update waiting in the buffer
+
+    @staticmethod
+    def key(message):
+        return message.get('project_id'), json.dumps(message.get('ids'), sort_keys=True)
+
+    def merge(self, entry, message):
+        """
+        Merge an update into the pending update of the same customer and return the pending one with the growth
+         of its encoded size, or return None if there is none and the entry becomes pending.
+        """
+        pending = self._pending.get(entry.update)
+        if pending is None:
+            self._pending[entry.update] = entry
+            return None
+
+        # only the encoded command is kept, so that buffered updates do not hold the caller's objects
+        merged = self._serializer.loads(pending.encoded)
+        properties = merged['data'].get('properties') or {}
+        properties.update(message.get('properties') or {})
+        merged['data']['properties'] = properties
+        size = len(pending.encoded)
+        pending.encoded = self._serializer.dumps(merged)
+        return pending, len(pending.encoded) - size
+
+    def taken(self, entry):
+        """
+        Forget an update taken from the buffer, later updates of the customer are not merged into it.
+        """
+        if entry.update is not None and self._pending.get(entry.update) is entry:
+            del self._pending[entry.update]
+
+    def clear(self):
+        self._pending.clear()
+
+
+class _Worker(threading.Thread):
+    """
+    Sender thread of AsynchronousTransport; any number of them can share one _WorkerData.
+    """
+
+    def __init__(self, data):
+        super(_Worker, self).__init__()
+        self._data = data
+
+    def run(self):
+        data = self._data
+        data.cv.acquire()
+
+        while True:
+            size = len(data.buffer)
+            # after close, retries are due right away
+            backoff_in = data.backoff_until - time.time() if size > 0 and not data.stop else None
+            timeout_in = data.buffer[0].scheduled + data.batching.linger - time.time() if size > 0 else None
+            timeouted = timeout_in is not None and timeout_in < 0
+
+            if backoff_in is not None and backoff_in > 0:
+                # the whole buffer waits, so that the retried commands at its head are sent before newer ones
+                data.cv.wait(backoff_in)
+            elif (size > 0 and (data.flush or data.stop)) or size > data.batching.batch_size or timeouted or \
+                    data.buffered_bytes >= data.bulk_max_bytes:
+                selected = self._take_bulk()
+                try:
+                    self._send_bulk(selected)
+                except Exception as e:
+                    # a dead worker would leave the buffer full and block the callers for good
+                    data.errors.handle(u('Infinario bulk request failed: {0!r}').format(e), ServiceUnavailable,
+                                       no_raise=True)
+                    self._retry(selected)
+                if len(data.buffer) == 0:
+                    data.flush = False
+            else:
+                if data.stop:
+                    break
+                data.cv.wait(timeout_in)
+
+        data.running -= 1
+        if data.running == 0 and data.spool is not None:
+            data.spool.close()
+        data.cv.release()
+
+    def _take_bulk(self):
+        data = self._data
+        selected, size = [], 0
+        while data.buffer and len(selected) < data.batching.batch_size and \
+                (not selected or size + len(data.buffer[0].encoded) <= data.bulk_max_bytes):
+            entry = data.buffer.popleft()
+            if data.coalescer is not None:
+                data.coalescer.taken(entry)
+            selected.append(entry)
+            size += len(entry.encoded)
+        data.buffered_bytes -= size
+        data.not_full.notify_all()
+        return selected
+
+    def _send_bulk(self, selected):
+        """
+        Send a bulk with the lock released and handle the results; `selected` is emptied once every command
+         was acknowledged, retried or given up.
+        """
+        data = self._data
+        body = _encode_bulk([entry.encoded for entry in selected])
+
+        data.cv.release()
+        try:
+            started = time.time()
+            # there is no caller to raise to in a worker thread, failures are always only logged
+            response = data.transport.send_encoded('bulk', body, no_raise=True)
+            rtt = time.time() - started
+            if data.metrics is not None:
+                data.metrics.observe('bulk_seconds', rtt)
+                data.metrics.observe('bulk_count', len(selected))
+                data.metrics.observe('bulk_bytes', len(body))
+        finally:
+            data.cv.acquire()
+
+        outcome = _sort_bulk(selected, response)
+        if outcome is None:
+            entries = selected[:]
+            del selected[:]
+            self._retry(entries)
+            data.batching.observe(None, len(entries), len(entries), len(data.buffer))
+            return
+
+        ok, leftovers, failed = outcome
+        for _, status, errors in failed:
+            data.errors.handle(_bulk_failure(status, errors), ServiceUnavailable, no_raise=True)
+
+        if data.metrics is not None:
+            data.metrics.increment('commands_sent', len(ok))
+            data.metrics.increment('commands_failed', len(failed))
+        if data.spool is not None:
+            data.spool.ack([entry.seq for entry in ok] + [entry.seq for entry, _, _ in failed])
+        count = len(selected)
+        del selected[:]
+        self._retry(leftovers)
+        data.batching.observe(rtt, count, len(leftovers), len(data.buffer))
+
+    def _retry(self, entries):
+        """
+        Put commands back at the head of the buffer and hold back the next bulk according to the retry policy,
+         or give up on them.
+        """
+        data, now = self._data, time.time()
+        if data.metrics is not None:
+            data.metrics.increment('commands_retried', len(entries))
+        if data.stop and data.spool is not None:
+            return  # not acknowledged in the spool, so they are sent again on the next start
+
+        retried, exhausted, due = _apply_retry_policy(data.retry_policy, entries, now)
+        if retried:
+            # retried commands are older than the buffered ones, e.g. earlier updates of the same customer
+            data.buffer.extendleft(reversed(retried))
+            data.buffered_bytes += sum(len(entry.encoded) for entry in retried)
+            data.backoff_until = max(data.backoff_until, due)
+
+        if exhausted:
+            if data.metrics is not None:
+                data.metrics.increment('commands_dead_lettered', len(exhausted))
+            if data.spool is not None:
+                data.spool.ack([entry.seq for entry in exhausted])
+            self._dead_letter(exhausted, 'retries exhausted')
+
+    def _dead_letter(self, entries, reason):
+        data = self._data
+        commands = [data.serializer.loads(entry.encoded) for entry in entries]
+        data.cv.release()
+        try:
+            _dead_letter(data.retry_policy, commands, reason, data.errors)
+        finally:
+            data.cv.acquire()
+
+
 # DEPRECATED - we recommend against using this transport mode, we cannot guarantee all data will be sent
 class AsynchronousTransport(object):
     """
-    AsynchronousTransport is a buffered asynchronous transport using one lazy-initialized thread and requests.Session.
-     This transport requires that the close method is called once the client will no longer be used.
+    AsynchronousTransport is a buffered asynchronous transport using lazy-initialized worker threads
+     and requests.Session. This transport requires that the close method is called once the client
+     will no longer be used.
 
     Infinario method get_html may block for the whole time of a request;
-     methods identify, track, update, flush and close are non-blocking (consult class Infinario for more information).
-    Asynchronous commands will be buffered up to ASYNC_BUFFER_MAX_SIZE of commands and will be flushed at most after
-     ASYNC_BUFFER_TIMEOUT seconds.
+     methods identify, track, update, flush and close are non-blocking (consult class Infinario for more information)
+     unless the buffer is full and overflow is OVERFLOW_BLOCK.
+    Requests with a response (get_html, get_segment, ...) do not wait for bulk requests: they use their own pool
+     of `interactive_pool_size` keep-alive connections, with `interactive_timeout` unless the call gives a timeout.
+     With `prewarm`, that many of these connections are opened in the background when the transport is created.
+    Asynchronous commands will be buffered up to `bulk_max_size` of commands (ASYNC_BUFFER_MAX_SIZE) or
+     `bulk_max_bytes` of encoded commands and will be flushed at most after ASYNC_BUFFER_TIMEOUT seconds by one
+     of the `workers` threads, each sending its own bulk requests; `compression` is applied to the bulk requests
+     as in SynchronousTransport. With `batching=AdaptiveBatching(...)`, the bulk size and the time commands wait
+     for a bulk are tuned at runtime instead (overriding `bulk_max_size`), see the `batching` property.
+    At most `capacity` commands are buffered, and with `buffer_max_bytes`, at most that many bytes of encoded commands
+     including those to be retried; once full, new commands block the caller (OVERFLOW_BLOCK)
+     or the oldest (OVERFLOW_DROP_OLDEST) or the new (OVERFLOW_DROP_NEWEST) commands are dropped.
+     Buffered commands are kept only encoded, in objects with __slots__, so their memory is close to their size.
+    Commands the API asks to retry, and commands of failed bulk requests, are put back at the head of the buffer
+     and no bulk is sent until a delay according to the `retry_policy` (see RetryPolicy) passed, so that commands
+     are not reordered; `circuit_breaker` is passed to SynchronousTransport.
+    With `spool_dir`, buffered commands are also written to a disk spool (see _DiskSpool) and the commands
+     not acknowledged by the API in a previous run are sent again when the transport is created.
+    Commands are encoded by the `serializer` when they are buffered, bulk requests are assembled from the encoded
+     commands.
+    With `metrics` (see class Metrics), the transport counts commands, measures bulks and the time callers wait
+     for the buffer lock, and reports the buffer depth.
+    With `coalesce_updates`, a customer update is merged into an update of the same customer still waiting
+     in the buffer (the properties of the later update win) instead of being buffered as another command.
+    In a process forked after the transport was created (e.g. gunicorn or multiprocessing workers), the transport
+     starts over with an empty buffer and its own worker threads and connections; the commands buffered before
+     the fork are sent by the parent process, which also keeps the disk spool.
+
+    Use functools.partial to pass the keyword arguments through the Infinario constructor.
     """
 
-    def __init__(self, target, errors, session=None):
+    def __init__(self, target, errors, session=None,
+                 workers=ASYNC_WORKERS, capacity=ASYNC_BUFFER_CAPACITY, overflow=OVERFLOW_BLOCK,
+                 spool_dir=None, spool_fsync_interval=SPOOL_FSYNC_INTERVAL, serializer=None,
+                 bulk_max_size=ASYNC_BUFFER_MAX_SIZE, bulk_max_bytes=ASYNC_BULK_MAX_BYTES,
+                 compression=None, compression_threshold=COMPRESSION_THRESHOLD, batching=None,
+                 retry_policy=None, circuit_breaker=None, metrics=None, coalesce_updates=False,
+                 interactive_pool_size=INTERACTIVE_POOL_SIZE, interactive_timeout=None, prewarm=0,
+                 buffer_max_bytes=None):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError('Unknown overflow policy {0!r}'.format(overflow))
+        if workers < 1 or capacity < 1:
+            raise ValueError('AsynchronousTransport needs at least one worker and a positive capacity')
+
+        lock = threading.Lock()
+        self._serializer = serializer or DEFAULT_SERIALIZER
+        session = session or _requests().Session()
+        self._interactive = SynchronousTransport(
+            target, errors, session=self._interactive_session(session, interactive_pool_size),
+            serializer=self._serializer, circuit_breaker=circuit_breaker, metrics=metrics)
+        self._interactive_timeout = interactive_timeout
         # any variables used by more than one thread shall be here
         self._worker_data = _WorkerData(
             errors=errors,
-            transport=SynchronousTransport(target, errors, session=session),
-            buffer=[],
-            cv=threading.Condition(threading.Lock()),
+            transport=SynchronousTransport(target, errors, session=session, serializer=self._serializer,
+                                           compression=compression, compression_threshold=compression_threshold,
+                                           circuit_breaker=circuit_breaker, metrics=metrics),
+            metrics=metrics,
+            serializer=self._serializer,
+            coalescer=_UpdateCoalescer(self._serializer) if coalesce_updates else None,
+            retry_policy=retry_policy or RetryPolicy(),
+            backoff_until=0,  # time before which no bulk is sent after a retry
+            buffer=collections.deque(),
+            buffered_bytes=0,
+            batching=batching or FixedBatching(bulk_max_size),
+            bulk_max_bytes=bulk_max_bytes,
+            cv=threading.Condition(lock),
+            not_full=threading.Condition(lock),
+            capacity=capacity,
+            buffer_max_bytes=buffer_max_bytes,
+            overflow=overflow,
+            dropped=0,
+            spool=_DiskSpool(spool_dir, fsync_interval=spool_fsync_interval) if spool_dir else None,
+            running=0,
             flush=False,
             stop=False
         )
-        self._worker_running = False
+        self._worker_count = workers
+        self._workers = []
+        self._pid = os.getpid()
+        _fork_aware[id(self)] = self
+
+        if prewarm:
+            warmer = threading.Thread(target=self._interactive.prewarm, args=(prewarm,))
+            warmer.daemon = True
+            warmer.start()
+
+        if metrics is not None:
+            data = self._worker_data
+            metrics.gauge('buffer_depth', lambda: len(data.buffer))
+            metrics.gauge('buffer_bytes', lambda: data.buffered_bytes)
+            # retried commands are at the head of the buffer
+            metrics.gauge('retry_depth', lambda: sum(1 for _ in itertools.takewhile(
+                lambda entry: entry.attempts, data.buffer)))
+
+        if self._worker_data.spool is not None:
+            for seq, encoded in self._worker_data.spool.recover():
+                self._worker_data.buffer.append(_BufferedCommand(encoded, time.time(), seq))
+                self._worker_data.buffered_bytes += len(encoded)
+            if self._worker_data.buffer:
+                # recovered commands are overdue, so they are sent right away
+                self._worker_data.flush = True
+                self._ensure_lazy_worker()
+
+    @property
+    def batching(self):
+        """
+        The batching of bulks; `batching.settings()` gives the current bulk size and linger time.
+        """
+        return self._worker_data.batching
+
+    @property
+    def dropped(self):
+        """
+        Number of commands dropped due to the overflow policy.
+        """
+        return self._worker_data.dropped
+
+    def pressure(self):
+        """
+        How full the buffer is, from 0 to 1.
+        """
+        return len(self._worker_data.buffer) / float(self._worker_data.capacity)
+
+    @staticmethod
+    def _interactive_session(session, pool_size):
+        requests = _requests()
+        interactive = requests.Session()
+        interactive.headers.update(session.headers)
+        interactive.auth, interactive.proxies, interactive.verify, interactive.cert = \
+            session.auth, session.proxies, session.verify, session.cert
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        interactive.mount('https://', adapter)
+        interactive.mount('http://', adapter)
+        return interactive
 
     def send_and_receive(self, service, message, no_raise=False, timeout=None):
-        return self._worker_data.transport.send_and_receive(service, message, no_raise=no_raise, timeout=timeout)
+        return self._interactive.send_and_receive(service, message, no_raise=no_raise,
+                                                  timeout=timeout if timeout is not None else self._interactive_timeout)
+
+    def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        # exports are bulk traffic and may take long, so they use the connections of the workers
+        return self._worker_data.transport.send_and_stream(service, message, no_raise=no_raise, timeout=timeout,
+                                                           chunk_size=chunk_size)
+
+    def prewarm(self, connections=1):
+        """
+        Open `connections` keep-alive connections for requests with a response before they are needed.
+        """
+        self._interactive.prewarm(connections)
 
     def send_and_ignore(self, service, message):
-        command = {'name': service, 'data': message, 'scheduled': time.time()}
+        scheduled = time.time()
+        entry = _BufferedCommand(
+            self._serializer.dumps({'name': service, 'data': message, 'scheduled': scheduled}), scheduled)
+        if service == 'crm/customers' and self._worker_data.coalescer is not None:
+            entry.update = _UpdateCoalescer.key(message)
+            self._buffer(entry, message)
+        else:
+            self._buffer(entry)
+
+    def buffer_encoded(self, encoded):
+        """
+        Buffer a command already encoded by the serializer as {'name': service, 'data': message, 'scheduled': time},
+         e.g. one handed over to the SidecarCollector. Such commands are not coalesced.
+        """
+        self._buffer(_BufferedCommand(encoded, time.time()))
+
+    def _buffer(self, entry, update=None):
+        if _register_at_fork is None and self._pid != os.getpid():
+            self._after_fork()
         self._ensure_lazy_worker()
+        data = self._worker_data
+        metrics = data.metrics
+        if metrics is not None:
+            metrics.increment('commands_enqueued')
+            waiting = _monotonic()
+
+        with data.cv:
+            if metrics is not None:
+                metrics.observe('lock_wait_seconds', _monotonic() - waiting)
+            if entry.update is not None and self._coalesce(entry, update):
+                return
+            size = len(entry.encoded)
+            if self._full(size):
+                if data.overflow == OVERFLOW_DROP_NEWEST:
+                    data.dropped += 1
+                    if metrics is not None:
+                        metrics.increment('commands_dropped')
+                    return
+                elif data.overflow == OVERFLOW_DROP_OLDEST:
+                    while data.buffer and self._full(size):
+                        dropped = data.buffer.popleft()
+                        if data.coalescer is not None:
+                            data.coalescer.taken(dropped)
+                        data.buffered_bytes -= len(dropped.encoded)
+                        data.dropped += 1
+                        if metrics is not None:
+                            metrics.increment('commands_dropped')
+                        if data.spool is not None:
+                            data.spool.ack([dropped.seq])
+                else:
+                    while self._full(size) and not data.stop:
+                        data.not_full.wait()
+                    if data.stop:
+                        raise ValueError('The API is already closed')
+
+            if data.spool is not None:
+                entry.seq = data.spool.append(entry.encoded)
+            data.buffer.append(entry)
+            data.buffered_bytes += size
+            # workers only need waking up for a new timeout or a full bulk
+            if len(data.buffer) == 1 or len(data.buffer) > data.batching.batch_size or \
+                    data.buffered_bytes >= data.bulk_max_bytes:
+                data.cv.notify()
+
+    def _full(self, size):
+        """
+        Whether a command of `size` bytes does not fit in the buffer.
+        """
+        data = self._worker_data
+        if len(data.buffer) >= data.capacity:
+            return True
+        # one command always fits, even if it is bigger than the limit
+        return data.buffer_max_bytes is not None and data.buffer and \
+            data.buffered_bytes + size > data.buffer_max_bytes
 
-        with self._worker_data.cv:
-            self._worker_data.buffer.append(command)
-            self._worker_data.cv.notify()
+    def _coalesce(self, entry, message):
+        data = self._worker_data
+        merged = data.coalescer.merge(entry, message)
+        if merged is None:
+            return False
+
+        pending, growth = merged
+        data.buffered_bytes += growth
+        if data.spool is not None:
+            seq, pending.seq = pending.seq, data.spool.append(pending.encoded)
+            data.spool.ack([seq])
+        if data.metrics is not None:
+            data.metrics.increment('commands_coalesced')
+        return True
+
+    def _after_fork(self):
+        data = self._worker_data
+        lock = threading.Lock()
+        data.cv = threading.Condition(lock)
+        data.not_full = threading.Condition(lock)
+        data.buffer = collections.deque()
+        data.buffered_bytes = 0
+        data.backoff_until = 0
+        data.running = 0
+        data.flush = False
+        data.spool = None
+        if data.coalescer is not None:
+            data.coalescer.clear()
+        if data.metrics is not None:
+            data.metrics._lock = threading.Lock()
+        if _register_at_fork is None:
+            data.transport._after_fork()
+        self._workers = []
+        self._pid = os.getpid()
 
     def _ensure_lazy_worker(self):
         if self._worker_data.stop:
             raise ValueError('The API is already closed')
-        if self._worker_running:
+        if self._workers:
             return
 
-        data = self._worker_data
+        with self._worker_data.cv:
+            if self._workers:
+                return
+            self._worker_data.running = self._worker_count
+            for _ in range(self._worker_count):
+                worker = _Worker(self._worker_data)
+                worker.start()
+                self._workers.append(worker)
+
+    def flush(self):
+        with self._worker_data.cv:
+            self._worker_data.flush = True
+            self._worker_data.cv.notify_all()
 
-        class Worker(threading.Thread):
+    def stop(self):
+        with self._worker_data.cv:
+            self._worker_data.stop = True
+            self._worker_data.flush = True
+            self._worker_data.cv.notify_all()
+            self._worker_data.not_full.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until the worker threads finish sending the buffered commands after stop.
+        """
+        for worker in self._workers:
+            worker.join(timeout)
+
+
+def _sidecar_socket_path():
+    """
+    Default path of the SidecarCollector's socket: SIDECAR_SOCKET in $XDG_RUNTIME_DIR, or else in a directory
+     of the temp dir that only the current user can access, created if missing, so that other users can neither
+     receive the commands nor send their own.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = os.path.join(tempfile.gettempdir(), 'infinario-{0}'.format(os.getuid()))
+        try:
+            os.mkdir(runtime_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        info = os.lstat(runtime_dir)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise ValueError('{0} is not a private directory of the current user, pass a socket path'.format(
+                runtime_dir))
+    return os.path.join(runtime_dir, SIDECAR_SOCKET)
+
+
+class SidecarTransport(object):
+    """
+    SidecarTransport hands commands sent by send_and_ignore over a Unix datagram socket to a SidecarCollector
+     running on the same host, which merges the commands of all processes into large bulk requests.
+
+    Handing over a command is a single system call, which waits at most SIDECAR_SEND_TIMEOUT while the collector's
+     socket is full. Commands that cannot be handed over (no collector is running, it does not keep up or the command
+     is larger than SIDECAR_MAX_DATAGRAM) are sent directly as by SynchronousTransport. Requests with a response,
+     e.g. get_html, are always sent directly. Datagrams are atomic, so the transport is safe to use after a fork.
+    `circuit_breaker` and `metrics` apply to the requests sent directly, see SynchronousTransport.
+    """
+
+    def __init__(self, target, errors, session=None, socket_path=None, serializer=None,
+                 circuit_breaker=None, metrics=None):
+        """
+        :param socket_path: Path of the collector's Unix socket, by default SIDECAR_SOCKET in the directory
+            of _sidecar_socket_path
+        """
+        self._serializer = serializer or DEFAULT_SERIALIZER
+        self._direct = SynchronousTransport(target, errors, session=session, serializer=self._serializer,
+                                            circuit_breaker=circuit_breaker, metrics=metrics)
+        self._socket_path = socket_path or _sidecar_socket_path()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.settimeout(SIDECAR_SEND_TIMEOUT)
 
-            def run(self):
-                data.cv.acquire()
+    def send_and_receive(self, service, message, no_raise=False, timeout=None):
+        return self._direct.send_and_receive(service, message, no_raise=no_raise, timeout=timeout)
 
-                while True:
-                    size = len(data.buffer)
-                    timeout_in = data.buffer[0]['scheduled'] + ASYNC_BUFFER_TIMEOUT - time.time() if size > 0 else None
-                    timeouted = timeout_in is not None and timeout_in < 0
+    def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        return self._direct.send_and_stream(service, message, no_raise=no_raise, timeout=timeout,
+                                            chunk_size=chunk_size)
 
-                    if (size > 0 and data.flush) or size > ASYNC_BUFFER_MAX_SIZE or timeouted:
-                        self._send_bulk()
-                        if len(data.buffer) == 0:
-                            data.flush = False
-                    else:
-                        if data.stop:
-                            break
-                        data.cv.wait(timeout_in)
+    def send_and_ignore(self, service, message):
+        payload = self._serializer.dumps({'name': service, 'data': message, 'scheduled': time.time()})
+        if len(payload) <= SIDECAR_MAX_DATAGRAM:
+            try:
+                self._socket.sendto(payload, self._socket_path)
+                return
+            except (socket.error, OSError):
+                pass
+        self._direct.send_and_ignore(service, message)
 
-                data.cv.release()
+    def stop(self):
+        self._socket.close()
 
-            def _send_bulk(self):
-                selected = data.buffer[:ASYNC_BUFFER_MAX_SIZE]
-                message = {'commands': selected}
 
-                data.cv.release()
+class SidecarCollector(object):
+    """
+    Local daemon receiving commands from the SidecarTransport of any number of processes and sending them
+     in large bulk requests over one `transport`, by default AsynchronousTransport with bulks of SIDECAR_BULK_SIZE.
 
-                leftovers, errors = [], []
-                results = data.transport.send_and_receive('bulk', message)['results']
+        python infinario.py collector --target https://api.infinario.com/
+    """
 
-                data.cv.acquire()
+    def __init__(self, target=None, socket_path=None, transport=None, silent=True, logger=None):
+        """
+        :param target: Tracking API URL
+        :param socket_path: Path of the Unix socket to receive commands on, replaced if it already exists,
+            by default SIDECAR_SOCKET in the directory of _sidecar_socket_path; only the current user can access it
+        :param transport: AsynchronousTransport, configured by functools.partial if needed, or another transport
+            with a `buffer_encoded` method
+        """
+        self._client = Infinario(None, target=target, silent=silent, logger=logger,
+                                 transport=transport or functools.partial(AsynchronousTransport,
+                                                                          bulk_max_size=SIDECAR_BULK_SIZE))
+        self._socket_path = socket_path = socket_path or _sidecar_socket_path()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self._socket.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SIDECAR_RECEIVE_BUFFER)
+        except (socket.error, OSError):
+            pass
+        self._socket.settimeout(SIDECAR_POLL_INTERVAL)
+        self._stop = False
 
-                for i, command in enumerate(selected):
-                    status = results[i].get('status', 'missing') if i < len(results) else 'retry'
+    @property
+    def transport(self):
+        return self._client._transport
 
-                    if status == 'ok':
-                        pass
-                    elif status == 'retry':
-                        leftovers.append(command)
-                    else:
-                        errors.append('Infinario API bulk command failed with status {0}, errors: {1}'.format(
-                            status, str(results[i].get('errors', []))
-                        ))
+    def serve_forever(self):
+        """
+        Receive and send commands until stop is called, then send the buffered commands and return.
+        """
+        transport = self._client._transport
+        try:
+            while not self._stop:
+                try:
+                    payload = self._socket.recv(SIDECAR_MAX_DATAGRAM)
+                except socket.timeout:
+                    continue
+                transport.buffer_encoded(payload)
+
+            # commands received before stop are still sent
+            self._socket.setblocking(False)
+            while True:
+                try:
+                    payload = self._socket.recv(SIDECAR_MAX_DATAGRAM)
+                except (socket.error, OSError):
+                    break
+                transport.buffer_encoded(payload)
+        finally:
+            self._socket.close()
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._client.close()
+            getattr(transport, 'join', lambda: None)()
 
-                for message in errors:
-                    data.errors.handle(message, ServiceUnavailable)  # die after the first exception
+    def stop(self):
+        self._stop = True
 
-                data.buffer = leftovers + data.buffer[ASYNC_BUFFER_MAX_SIZE:]
 
-        Worker().start()
-        self._worker_running = True
+class RecordingTransport(object):
+    """
+    RecordingTransport records every send_and_ignore, send_and_receive and send_and_stream call with its time,
+     and the duration until the response of calls with one, to the file at `path`, and passes the calls on
+     to the transport made by `transport`. Commands buffered by buffer_encoded are recorded as send_and_ignore
+     calls. Recordings are played back by Replayer or the `replay` command.
+
+    Records are kept in memory and appended to the file in chunks of `chunk_size` bytes, so a call costs only
+     encoding the message once more; the file is complete once the transport is stopped. Processes forked meanwhile
+     append their own records to the same file.
+    """
+
+    uses_requests = None  # as the recorded transport
+    _RECORD = struct.Struct('>dfBHI')  # time, duration, kind, service length, message length
+    _IGNORE = 0
+    _RECEIVE = 1
+    _STREAM = 2
+
+    def __init__(self, target, errors, session=None, path=None, transport=SynchronousTransport, serializer=None,
+                 metrics=None, chunk_size=RECORDING_CHUNK_SIZE, secret=None):
+        if path is None:
+            raise ValueError('RecordingTransport needs the path of the recording')
+        kwargs = {} if metrics is None else {'metrics': metrics}
+        if _uses_requests(transport):
+            kwargs['session'] = session
+        else:
+            if session is not None:
+                secret = secret or session.headers.get('X-Infinario-Secret')
+            if secret:
+                kwargs['secret'] = secret
+        self._transport = transport(target, errors, **kwargs)
+        self._serializer = serializer or DEFAULT_SERIALIZER
+        self._chunk_size = chunk_size
+        self._chunk = bytearray()
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        _fork_aware[id(self)] = self
+
+    def __getattr__(self, name):
+        # e.g. pressure, prewarm or join of the recorded transport
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._transport, name)
+
+    def _after_fork(self):
+        # records of the parent still in memory are written by the parent
+        self._chunk = bytearray() if self._chunk is not None else None
+        self._lock = threading.Lock()
+
+    def _record(self, kind, service, message, started, duration):
+        service = u(service).encode('utf-8')
+        body = self._serializer.dumps(message)
+        record = self._RECORD.pack(started, duration, kind, len(service), len(body)) + service + body
+        with self._lock:
+            if self._chunk is None:
+                return
+            self._chunk += record
+            if len(self._chunk) >= self._chunk_size:
+                self._write()
+
+    def _write(self):
+        chunk, self._chunk = self._chunk, bytearray()
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    def send_and_ignore(self, service, message):
+        self._record(self._IGNORE, service, message, time.time(), 0.0)
+        self._transport.send_and_ignore(service, message)
+
+    def send_and_receive(self, service, message, no_raise=False, timeout=None):
+        started = time.time()
+        try:
+            return self._transport.send_and_receive(service, message, no_raise=no_raise, timeout=timeout)
+        finally:
+            self._record(self._RECEIVE, service, message, started, time.time() - started)
+
+    def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        started = time.time()
+        try:
+            return self._transport.send_and_stream(service, message, no_raise=no_raise, timeout=timeout,
+                                                   chunk_size=chunk_size)
+        finally:
+            self._record(self._STREAM, service, message, started, time.time() - started)
+
+    def buffer_encoded(self, encoded):
+        command = self._serializer.loads(encoded)
+        self._record(self._IGNORE, command['name'], command['data'], time.time(), 0.0)
+        self._transport.buffer_encoded(encoded)
 
     def flush(self):
-        with self._worker_data.cv:
-            self._worker_data.flush = True
-            self._worker_data.cv.notify()
+        getattr(self._transport, 'flush', lambda: None)()
+        with self._lock:
+            if self._chunk:
+                self._write()
 
     def stop(self):
-        with self._worker_data.cv:
-            self._worker_data.stop = True
-            self._worker_data.flush = True
-            self._worker_data.cv.notify()
+        getattr(self._transport, 'stop', lambda: None)()
+        with self._lock:
+            if self._chunk is None:
+                return
+            self._write()
+            self._chunk = None
+            os.close(self._fd)
+
+
+class _Flight(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache(object):
+    """
+    Thread-safe cache of get_segment and get_html results, see the Infinario parameter `cache`.
+
+    Results are fresh for `ttl` seconds and at most `max_size` of them are kept, evicting the least recently used.
+     Concurrent lookups of the same key share a single request. With `stale_ttl`, an expired result is still
+     returned for up to `stale_ttl` more seconds while a background thread fetches a new one.
+    Failed requests are never cached.
+    """
+
+    def __init__(self, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL, stale_ttl=0):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._entries = collections.OrderedDict()  # key -> (value, expiration), least recently used first
+        self._flights = {}  # key -> _Flight of the request loading it
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('hits', 'stale_hits', 'misses', 'coalesced', 'evictions'), 0)
+
+    def get(self, key, load):
+        """
+        Get the result for a key, calling `load` if it is not cached; `load` returns a (result, cacheable) tuple.
+        """
+        now = _monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[1] + self._stale_ttl:
+                self._entries[key] = self._entries.pop(key)
+                if now < entry[1]:
+                    self._stats['hits'] += 1
+                    return entry[0]
+                self._stats['stale_hits'] += 1
+                if key not in self._flights:
+                    flight = self._flights[key] = _Flight()
+                    refresh = threading.Thread(target=self._load, args=(key, load, flight))
+                    refresh.daemon = True
+                    refresh.start()
+                return entry[0]
+
+            flight = self._flights.get(key)
+            owner = flight is None
+            if owner:
+                self._stats['misses'] += 1
+                flight = self._flights[key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if owner:
+            self._load(key, load, flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, load, flight):
+        try:
+            flight.value, cacheable = load()
+        except Exception as e:
+            flight.error, cacheable = e, False
+
+        with self._lock:
+            del self._flights[key]
+            if cacheable:
+                self._entries.pop(key, None)
+                self._entries[key] = (flight.value, _monotonic() + self._ttl)
+                while len(self._entries) > self._max_size:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        flight.done.set()
+
+    def stats(self):
+        """
+        Get the numbers of hits, stale hits, misses, coalesced lookups and evictions, and the current size.
+        """
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _TokenBucket(object):
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = _monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = _monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class TrackingPolicy(object):
+    """
+    Decides which tracked events are sent, see the `policy` argument of Infinario.
+
+    `sample_rates` maps event types to the fraction of their events to send, `rate_limits` maps event types to
+     (events per second, burst) of a token bucket and `priorities` maps event types to PRIORITY_HIGH, PRIORITY_NORMAL
+     or PRIORITY_LOW. The key '*' gives the default for event types not listed (each type gets its own bucket).
+    While the buffer of the transport is filled to at least `shed_at[priority]` of its capacity, events of the
+     priority are dropped; by default low priority events at 50% and normal ones at 90%, high priority never.
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None, priorities=None, shed_at=None):
+        self._sample_rates = sample_rates or {}
+        self._rate_limits = rate_limits or {}
+        self._priorities = priorities or {}
+        self._shed_at = dict(POLICY_SHED_AT, **(shed_at or {}))
+        self._rules = {}  # event type -> (sample rate, token bucket, shed at)
+        self._lock = threading.Lock()
+        self._dropped = collections.defaultdict(int)
+
+    def allow(self, event_type, pressure=None):
+        """
+        Whether an event of the type should be sent; `pressure` returns how full the buffer is (0 to 1).
+        """
+        rule = self._rules.get(event_type)
+        if rule is None:
+            rule = self._rule(event_type)
+        sample_rate, bucket, shed_at = rule
+
+        if shed_at is not None and pressure is not None and pressure() >= shed_at:
+            return self._drop(event_type, 'shed')
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return self._drop(event_type, 'sampled')
+        if bucket is not None and not bucket.take():
+            return self._drop(event_type, 'rate_limited')
+        return True
+
+    def dropped(self):
+        """
+        Numbers of dropped events by (event type, reason); reasons are `shed`, `sampled` and `rate_limited`.
+        """
+        with self._lock:
+            return dict(self._dropped)
+
+    def _rule(self, event_type):
+        with self._lock:
+            if event_type not in self._rules:
+                limit = self._rate_limits.get(event_type, self._rate_limits.get('*'))
+                priority = self._priorities.get(event_type, self._priorities.get('*', PRIORITY_NORMAL))
+                self._rules[event_type] = (
+                    self._sample_rates.get(event_type, self._sample_rates.get('*', 1)),
+                    _TokenBucket(*limit) if limit is not None else None,
+                    self._shed_at.get(priority),
+                )
+            return self._rules[event_type]
+
+    def _drop(self, event_type, reason):
+        with self._lock:
+            self._dropped[event_type, reason] += 1
+        return False
+
+
+BulkResult = collections.namedtuple('BulkResult', ['item', 'status', 'errors'])
 
 
 class Infinario(object):
@@ -256,8 +2033,8 @@ class Infinario(object):
     If the secret argument is passed, it also allows exporting analyses.
     """
 
-    def __init__(self, token,
-                 customer=None, target=None, silent=True, logger=None, transport=SynchronousTransport, secret=None):
+    def __init__(self, token, customer=None, target=None, silent=True, logger=None, transport=SynchronousTransport,
+                 secret=None, cache=None, metrics=None, policy=None):
         """
         :param token: Project token to track data into.
         :param customer: Optional identifier of tracked customer (can later be done with method `identify`).
@@ -267,6 +2044,9 @@ class Infinario(object):
         :param transport: One of `NullTransport`, `SynchronousTransport`, `AsynchronousTransport`;
             consult their documentation as well
         :param secret: (optional) Secret token of a project with analyses for `export_analysis` or `get_segment`
+        :param cache: (optional) `ResultCache` instance to cache the results of `get_segment` and `get_html` in
+        :param metrics: (optional) `Metrics` instance to measure the client and its transport in
+        :param policy: (optional) `TrackingPolicy` sampling, rate limiting and shedding the tracked events
         """
         errors = ErrorHandler(silent, logger)
         self._error_handler = errors
@@ -279,10 +2059,21 @@ class Infinario(object):
             self._target = DEFAULT_TARGET
         self._token = token
         self._customer = self._convert_customer_argument(customer)
-        session = requests.Session()
-        if secret:
-            session.headers.update({'X-Infinario-Secret': secret})
-        self._transport = transport(self._target, errors, session=session)
+        self._cache = cache
+        self._metrics = metrics
+        self._policy = policy
+        self._transport = self._create_transport(transport, errors, secret)
+        self._pressure = getattr(self._transport, 'pressure', None)
+
+    def _create_transport(self, transport, errors, secret):
+        kwargs = {} if self._metrics is None else {'metrics': self._metrics}
+        if _uses_requests(transport):
+            session = kwargs['session'] = _requests().Session()
+            if secret:
+                session.headers.update({'X-Infinario-Secret': secret})
+        elif secret:
+            kwargs['secret'] = secret
+        return transport(self._target, errors, **kwargs)
 
     def identify(self, customer=None, properties=None):
         """
@@ -299,11 +2090,7 @@ class Infinario(object):
         Update the properties of the currently identified customer.
         :param properties: Dictionary of properties
         """
-        self._transport.send_and_ignore('crm/customers', {
-            'ids': self._customer,
-            'project_id': self._token,
-            'properties': properties
-        })
+        self._update(self._customer, properties)
 
     def track(self, event_type, properties=None, timestamp=None):
         """
@@ -311,15 +2098,7 @@ class Infinario(object):
         :param event_type: Type of the event to track.
         :param properties: Optional dictionary of properties
         """
-        data = {
-            'customer_ids': self._customer,
-            'project_id': self._token,
-            'type': event_type,
-            'properties': {} if properties is None else properties
-        }
-        if timestamp is not None:
-            data['timestamp'] = self._convert_timestamp_argument(timestamp)
-        self._transport.send_and_ignore('crm/events', data)
+        self._track(self._customer, event_type, properties, timestamp)
 
     def get_html(self, html_campaign_name):
         """
@@ -327,12 +2106,7 @@ class Infinario(object):
         :param html_campaign_name: Name of the campaign
         :return: HTML code to display
         """
-        response = self._transport.send_and_receive('campaigns/html/get', {
-            'customer_ids': self._customer,
-            'project_id': self._token,
-            'html_campaign_name': html_campaign_name
-        })
-        return response['data']
+        return self._get_html(self._customer, html_campaign_name)
 
     def export_analysis(self, analysis_type, data):
         """
@@ -343,6 +2117,42 @@ class Infinario(object):
         """
         return self._transport.send_and_receive('analytics/{0}'.format(analysis_type), data)
 
+    def export_rows(self, analysis_type, data, timeout=None):
+        """
+        Export the result of an analysis as a stream of rows, parsed while the response is downloaded,
+         so that the memory used does not grow with the size of the result.
+
+        :param analysis_type: funnel/report/retention/segmentation
+        :param data: As in `export_analysis`, `format` must be `table-json` (default) or `csv`
+        :param timeout: optional, max number of seconds to wait for a piece of the response
+        :return: Iterator of rows (lists of values, strings with `csv`), the first one is the header
+        """
+        data = dict(data)
+        export_format = data.setdefault('format', 'table-json')
+        if export_format not in ('table-json', 'csv'):
+            raise ValueError('Analysis export format {0!r} cannot be streamed'.format(export_format))
+        chunks = self._transport.send_and_stream('analytics/{0}'.format(analysis_type), data, timeout=timeout)
+        if chunks is None:
+            return iter(())
+        if export_format == 'csv':
+            return csv.reader(_text_lines(chunks))
+        return _table_json_rows(chunks, self._error_handler)
+
+    def export_columns(self, analysis_type, data, batch_size=EXPORT_BATCH_SIZE, timeout=None):
+        """
+        Export the result of an analysis as a stream of column batches, see `export_rows`.
+        Columns can be turned into arrays directly, e.g. `numpy.asarray(batch['total'])`.
+
+        :return: Iterator of dictionaries mapping the header names to lists of at most `batch_size` values
+        """
+        rows = self.export_rows(analysis_type, data, timeout=timeout)
+        header = next(rows, None)
+        while header is not None:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield dict(zip(header, (list(column) for column in zip(*batch))))
+
     def get_segment(self, segmentation_id, timezone='UTC', timeout=0.5):
         """
         Compute the result of a segmentation for the identified customer
@@ -352,20 +2162,86 @@ class Infinario(object):
         :param timeout: optional, number of seconds to wait for the result, otherwise return None, default 0.5 seconds
         :returns segment name string for the customer, None if could not be determined
         """
-        try:
-            result = self._transport.send_and_receive('analytics/segmentation-for', {
-                'analysis_id': segmentation_id,
-                'customer_ids': self._customer,
-                'timezone': timezone,
-                'timeout': timeout,
-            }, no_raise=True, timeout=timeout)
-        except ServiceUnavailable:
-            return None
+        return self._get_segment(self._customer, segmentation_id, timezone, timeout)
 
-        if not result or not isinstance(result, dict):
-            return None
+    def get_segments(self, segmentation_id, customers, timezone='UTC', deadline=1, workers=SEGMENTS_WORKERS):
+        """
+        Compute the result of a segmentation for many customers with at most `workers` concurrent requests.
+        Repeated customers are requested only once.
 
-        return result.get('segment', None)
+        :param segmentation_id: id of the segmentation already stored in the Infinario project authenticated by secret
+        :param customers: Iterable of customer identifiers
+        :param timezone: optional, Olson TZ database string specifying the timezone, default UTC
+        :param deadline: optional, number of seconds to wait for all the results, default 1 second
+        :returns dictionary mapping the customer identifiers (dictionaries as JSON with sorted keys) to segment names,
+            None for customers whose segment could not be determined before the deadline
+        """
+        expires = _monotonic() + deadline
+        keys, pending = {}, collections.OrderedDict()
+        for customer in customers:
+            converted = self._convert_customer_argument(customer)
+            key = self._customer_key(converted)
+            keys[customer if isinstance(customer, basestring) else key] = key
+            pending.setdefault(key, converted)
+
+        state = _WorkerData(lock=threading.Lock(), pending=collections.deque(pending.items()), results={},
+                            unfinished=len(pending), done=threading.Event(), error=None)
+        if not pending:
+            state.done.set()
+        for _ in range(min(workers, len(pending))):
+            worker = threading.Thread(target=self._run_segments_worker,
+                                      args=(segmentation_id, timezone, expires, state))
+            worker.daemon = True
+            worker.start()
+
+        state.done.wait(max(0, expires - _monotonic()))
+        with state.lock:
+            if state.error is not None:
+                state.pending.clear()
+                raise state.error
+            return dict((customer, state.results.get(key)) for customer, key in keys.items())
+
+    def track_many(self, events, bulk_size=ASYNC_BUFFER_MAX_SIZE, on_result=None):
+        """
+        Track events of many customers in bulk requests of `bulk_size` events.
+        All events are sent before returning; they are read one bulk at a time, so any number of them can come
+         from a generator.
+        :param events: Iterable of dictionaries with the keys `type` and optionally `customer` (the identified customer
+            if missing), `properties` and `timestamp`
+        :param on_result: Optional callable receiving BulkResult(item, status, errors) for every event in the given
+            order as soon as its bulk request is done; status is `ok`, `retry` if the event should be tracked again
+            later, `failed` if the bulk request failed, `invalid` for malformed events or the status returned by the API
+        :return: Dictionary of the number of events by status
+        """
+        return self._send_many(events, self._event_command, bulk_size, on_result)
+
+    def update_many(self, updates, bulk_size=ASYNC_BUFFER_MAX_SIZE, on_result=None):
+        """
+        Update the properties of many customers in bulk requests, see `track_many`.
+        :param updates: Iterable of dictionaries with the keys `properties` and optionally `customer`
+        :param on_result: Optional callable receiving BulkResult(item, status, errors) for every update in the given
+            order
+        :return: Dictionary of the number of updates by status
+        """
+        return self._send_many(updates, self._update_command, bulk_size, on_result)
+
+    def customer(self, customer):
+        """
+        Get a handle for tracking a single customer through this client, see class Customer.
+        Unlike `identify`, handles do not change the state of the client and are safe to use from many threads.
+        :param customer: Customer identifier
+        """
+        return Customer(self, self._convert_customer_argument(customer))
+
+    def prewarm(self, connections=1):
+        """
+        Open connections to the API before they are needed, so that the first `get_segment` or `get_html`
+         does not wait for the TLS handshake. Does nothing if the transport does not support it.
+        :param connections: Number of keep-alive connections to open
+        """
+        prewarm = getattr(self._transport, 'prewarm', None)
+        if prewarm is not None:
+            prewarm(connections)
 
     def flush(self):
         """
@@ -381,6 +2257,181 @@ class Infinario(object):
         """
         getattr(self._transport, 'stop', lambda: None)()
 
+    def _update(self, customer, properties):
+        if self._metrics is not None:
+            self._metrics.increment('customers_updated')
+        self._transport.send_and_ignore('crm/customers', self._update_message(customer, properties))
+
+    def _track(self, customer, event_type, properties, timestamp):
+        if self._metrics is not None:
+            self._metrics.increment('events_tracked')
+        if self._policy is not None and not self._policy.allow(event_type, self._pressure):
+            if self._metrics is not None:
+                self._metrics.increment('events_dropped')
+            return
+        self._transport.send_and_ignore('crm/events', self._track_message(customer, event_type, properties, timestamp))
+
+    def _send_many(self, items, command, bulk_size, on_result):
+        counts = {}
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, bulk_size))
+            if not chunk:
+                return counts
+
+            results, commands, sent = self._many_commands(chunk, command)
+            if commands:
+                response = self._transport.send_and_receive('bulk', {'commands': commands}, no_raise=True)
+                self._many_results(chunk, results, sent, response)
+            for result in results:
+                counts[result.status] = counts.get(result.status, 0) + 1
+                if on_result is not None:
+                    on_result(result)
+
+    @staticmethod
+    def _many_commands(chunk, command):
+        """
+        Make the bulk commands of a chunk of `track_many` or `update_many`; malformed items get their result
+         right away, `sent` are the indices of the items that have a command.
+        """
+        results, commands, sent = [None] * len(chunk), [], []
+        for i, item in enumerate(chunk):
+            try:
+                commands.append(command(item))
+                sent.append(i)
+            except (KeyError, TypeError, ValueError) as e:
+                results[i] = BulkResult(item, 'invalid', [u('{0!r}').format(e)])
+        return results, commands, sent
+
+    @staticmethod
+    def _many_results(chunk, results, sent, response):
+        statuses = _bulk_statuses(sent, response)
+        for i, status, errors in statuses if statuses is not None else [(i, 'failed', []) for i in sent]:
+            results[i] = BulkResult(chunk[i], status, errors)
+
+    def _event_command(self, event):
+        customer = self._convert_customer_argument(event['customer']) if 'customer' in event else self._customer
+        return {'name': 'crm/events',
+                'data': self._track_message(customer, event['type'], event.get('properties'), event.get('timestamp'))}
+
+    def _update_command(self, update):
+        customer = self._convert_customer_argument(update['customer']) if 'customer' in update else self._customer
+        return {'name': 'crm/customers', 'data': self._update_message(customer, update['properties'])}
+
+    def _get_html(self, customer, html_campaign_name):
+        if self._metrics is not None:
+            return self._measure('get_html_seconds', self._lookup_html, customer, html_campaign_name)
+        return self._lookup_html(customer, html_campaign_name)
+
+    def _lookup_html(self, customer, html_campaign_name):
+        if self._cache is None:
+            return self._load_html(customer, html_campaign_name)[0]
+        return self._cache.get(('html', self._target, self._token, html_campaign_name, self._customer_key(customer)),
+                               lambda: self._load_html(customer, html_campaign_name))
+
+    def _load_html(self, customer, html_campaign_name):
+        response = self._transport.send_and_receive('campaigns/html/get',
+                                                    self._html_message(customer, html_campaign_name))
+        return response['data'], True
+
+    def _run_segments_worker(self, segmentation_id, timezone, expires, state):
+        while True:
+            timeout = expires - _monotonic()
+            with state.lock:
+                if not state.pending or timeout <= 0:
+                    return
+                key, customer = state.pending.popleft()
+
+            try:
+                segment = self._get_segment(customer, segmentation_id, timezone, timeout)
+            except Exception as e:
+                # not silent, raised in the caller
+                with state.lock:
+                    state.error = state.error or e
+                state.done.set()
+                return
+
+            with state.lock:
+                state.results[key] = segment
+                state.unfinished -= 1
+                if state.unfinished == 0:
+                    state.done.set()
+
+    def _get_segment(self, customer, segmentation_id, timezone, timeout):
+        if self._metrics is not None:
+            return self._measure('get_segment_seconds', self._lookup_segment, customer, segmentation_id, timezone,
+                                 timeout)
+        return self._lookup_segment(customer, segmentation_id, timezone, timeout)
+
+    def _lookup_segment(self, customer, segmentation_id, timezone, timeout):
+        if self._cache is None:
+            return self._load_segment(customer, segmentation_id, timezone, timeout)[0]
+        return self._cache.get(('segment', self._target, self._token, segmentation_id, timezone,
+                                self._customer_key(customer)),
+                               lambda: self._load_segment(customer, segmentation_id, timezone, timeout))
+
+    def _load_segment(self, customer, segmentation_id, timezone, timeout):
+        try:
+            result = self._transport.send_and_receive(
+                'analytics/segmentation-for', self._segment_message(customer, segmentation_id, timezone, timeout),
+                no_raise=True, timeout=timeout)
+        except ServiceUnavailable:
+            return None, False
+
+        return self._segment_from_result(result), isinstance(result, dict)
+
+    def _measure(self, name, function, *args):
+        started = _monotonic()
+        try:
+            return function(*args)
+        finally:
+            self._metrics.observe(name, _monotonic() - started)
+
+    def _update_message(self, customer, properties):
+        return {
+            'ids': customer,
+            'project_id': self._token,
+            'properties': properties
+        }
+
+    def _track_message(self, customer, event_type, properties, timestamp):
+        data = {
+            'customer_ids': customer,
+            'project_id': self._token,
+            'type': event_type,
+            'properties': {} if properties is None else properties
+        }
+        if timestamp is not None:
+            data['timestamp'] = self._convert_timestamp_argument(timestamp)
+        return data
+
+    def _html_message(self, customer, html_campaign_name):
+        return {
+            'customer_ids': customer,
+            'project_id': self._token,
+            'html_campaign_name': html_campaign_name
+        }
+
+    @staticmethod
+    def _segment_message(customer, segmentation_id, timezone, timeout):
+        return {
+            'analysis_id': segmentation_id,
+            'customer_ids': customer,
+            'timezone': timezone,
+            'timeout': timeout,
+        }
+
+    @staticmethod
+    def _segment_from_result(result):
+        if not result or not isinstance(result, dict):
+            return None
+
+        return result.get('segment', None)
+
+    @staticmethod
+    def _customer_key(customer):
+        return json.dumps(customer, sort_keys=True)
+
     @staticmethod
     def _convert_customer_argument(customer):
         if customer is None:
@@ -403,6 +2454,504 @@ class Infinario(object):
             raise ValueError('Cannot convert {0!r} to timestamp'.format(timestamp))
 
 
+class Customer(object):
+    """
+    Immutable handle for tracking a single customer through a shared Infinario client, see `Infinario.customer`.
+
+    Handles are cheap to create (e.g. one per web request) and all of them share the transport and connection pool
+     of the client, so they can be used from many threads at once. With AsyncInfinario, the methods return coroutines.
+    """
+
+    __slots__ = ('_client', '_ids')
+
+    def __init__(self, client, ids):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_ids', dict(ids))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Customer handles are immutable')
+
+    def __repr__(self):
+        return 'Customer({0!r})'.format(self._ids)
+
+    @property
+    def ids(self):
+        return dict(self._ids)
+
+    def update(self, properties):
+        """
+        Update the properties of the customer.
+        :param properties: Dictionary of properties
+        """
+        return self._client._update(self._ids, properties)
+
+    def track(self, event_type, properties=None, timestamp=None):
+        """
+        Track an event for the customer.
+        :param event_type: Type of the event to track.
+        :param properties: Optional dictionary of properties
+        """
+        return self._client._track(self._ids, event_type, properties, timestamp)
+
+    def get_html(self, html_campaign_name):
+        """
+        Get the HTML code to display in case the customer is targeted in a HTML campaign action.
+        :param html_campaign_name: Name of the campaign
+        :return: HTML code to display
+        """
+        return self._client._get_html(self._ids, html_campaign_name)
+
+    def get_segment(self, segmentation_id, timezone='UTC', timeout=0.5):
+        """
+        Compute the result of a segmentation for the customer, see `Infinario.get_segment`.
+        """
+        return self._client._get_segment(self._ids, segmentation_id, timezone, timeout)
+
+
+class BulkImporter(object):
+    """
+    BulkImporter streams large numbers of events or customer updates into Infinario in bulk requests
+     sent in parallel over `connections` keep-alive connections.
+
+    Records are dictionaries; events have the keys `customer` (or `customer_ids`), `type`, optionally `timestamp`
+     and `properties`, customer updates have the keys `customer` (or `ids`) and `properties`. Without a `properties`
+     key, all other keys are used as properties (as with CSV columns). Records with `name` and `data` keys are sent
+     as they are. Commands with the `retry` status are sent again with an exponential delay.
+    With a `checkpoint` file, the number of records already imported is saved regularly and a later import
+     with the same file skips them.
+    """
+
+    def __init__(self, client, kind='events', connections=IMPORT_CONNECTIONS, bulk_size=IMPORT_BULK_SIZE,
+                 checkpoint=None, progress=None, progress_interval=5):
+        """
+        :param client: Infinario client providing the token, target and error handling
+        :param kind: `events` or `customers`
+        :param checkpoint: Optional path of the checkpoint file
+        :param progress: Optional callable receiving the statistics every `progress_interval` seconds
+        """
+        if kind not in ('events', 'customers'):
+            raise ValueError('Unknown kind of records {0!r}'.format(kind))
+        self._client = client
+        self._kind = kind
+        self._transports = [SynchronousTransport(client._target, client._error_handler) for _ in range(connections)]
+        self._bulk_size = bulk_size
+        self._checkpoint = checkpoint
+        self._progress = progress
+        self._progress_interval = progress_interval
+
+    def run(self, records):
+        """
+        Import all records from an iterable and return the statistics of the import.
+        """
+        skip = self._load_checkpoint()
+        batches = queue.Queue(len(self._transports) * 2)
+        state = _WorkerData(
+            lock=threading.Lock(),
+            done={},  # finished batch number -> number of records imported including the batch
+            next_batch=0,
+            position=skip,
+            commands=0,
+            failed=0,
+            error=None,
+            started=time.time(),
+            saved=time.time(),
+        )
+        senders = [threading.Thread(target=self._run_sender, args=(transport, batches, state))
+                   for transport in self._transports]
+        for sender in senders:
+            sender.daemon = True
+            sender.start()
+
+        reported = time.time()
+        try:
+            batch, commands = 0, []
+            for position, record in enumerate(records):
+                if position < skip:
+                    continue
+                commands.append(self._command(record, position))
+                if len(commands) >= self._bulk_size:
+                    self._put(batches, (batch, position + 1, commands), state)
+                    batch, commands = batch + 1, []
+                if self._progress and time.time() - reported >= self._progress_interval:
+                    reported = time.time()
+                    self._progress(self._statistics(state))
+            if commands:
+                self._put(batches, (batch, position + 1, commands), state)
+        finally:
+            if state.error is not None:
+                while not batches.empty():
+                    batches.get_nowait()
+            for _ in senders:
+                batches.put(None)
+            for sender in senders:
+                sender.join()
+            self._save_checkpoint(state)
+
+        if state.error is not None:
+            raise state.error
+        return self._statistics(state)
+
+    def _command(self, record, position):
+        if 'name' in record and 'data' in record:
+            return {'name': record['name'], 'data': record['data']}
+
+        record = dict(record)
+        customer = record.pop('customer', None) or record.pop('customer_ids', None) or record.pop('ids', None)
+        try:
+            customer = self._client._convert_customer_argument(customer)
+            if self._kind == 'customers':
+                properties = record.pop('properties', record)
+                return {'name': 'crm/customers', 'data': self._client._update_message(customer, properties)}
+
+            event_type = record.pop('type')
+            timestamp = record.pop('timestamp', None)
+            properties = record.pop('properties', record)
+            if isinstance(timestamp, basestring):
+                timestamp = float(timestamp) if timestamp else None
+            return {'name': 'crm/events',
+                    'data': self._client._track_message(customer, event_type, properties, timestamp)}
+        except (KeyError, ValueError) as e:
+            raise ValueError('Invalid record {0}: {1!r}'.format(position + 1, e))
+
+    @staticmethod
+    def _put(batches, batch, state):
+        while state.error is None:
+            try:
+                return batches.put(batch, timeout=0.1)
+            except queue.Full:
+                pass
+        raise state.error
+
+    def _run_sender(self, transport, batches, state):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            number, end, commands = batch
+            try:
+                failed = self._send_commands(transport, commands)
+            except Exception as e:
+                with state.lock:
+                    state.error = e
+                return
+
+            with state.lock:
+                state.commands += len(commands)
+                state.failed += failed
+                state.done[number] = end
+                while state.next_batch in state.done:
+                    state.position = state.done.pop(state.next_batch)
+                    state.next_batch += 1
+                if self._checkpoint and time.time() - state.saved >= IMPORT_CHECKPOINT_INTERVAL:
+                    self._save_checkpoint(state)
+
+    def _send_commands(self, transport, commands):
+        errors = self._client._error_handler
+        failed = 0
+        policy = RetryPolicy(max_attempts=IMPORT_MAX_ATTEMPTS, base_delay=IMPORT_RETRY_DELAY)
+        for attempt in range(IMPORT_MAX_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(policy.delay(attempt))
+            try:
+                response = transport.send_and_receive('bulk', {'commands': commands})
+            except ServiceUnavailable:
+                continue
+            outcome = _sort_bulk(commands, response)
+            if outcome is None:
+                continue
+
+            _, commands, failures = outcome
+            for _, status, command_errors in failures:
+                failed += 1
+                errors.handle(_bulk_failure(status, command_errors), InvalidRequest, no_raise=True)
+            if not commands:
+                return failed
+
+        raise ServiceUnavailable('Infinario API bulk import failed after {0} attempts'.format(IMPORT_MAX_ATTEMPTS))
+
+    def _load_checkpoint(self):
+        if not self._checkpoint or not os.path.exists(self._checkpoint):
+            return 0
+        with open(self._checkpoint) as checkpoint:
+            return json.load(checkpoint)['records']
+
+    def _save_checkpoint(self, state):
+        if not self._checkpoint:
+            return
+        temporary = self._checkpoint + '.tmp'
+        with open(temporary, 'w') as checkpoint:
+            json.dump({'records': state.position}, checkpoint)
+        _replace_file(temporary, self._checkpoint)
+        state.saved = time.time()
+
+    @staticmethod
+    def _statistics(state):
+        seconds = time.time() - state.started
+        return {
+            'records': state.position,
+            'commands': state.commands,
+            'failed': state.failed,
+            'seconds': seconds,
+            'commands_per_second': state.commands / seconds if seconds > 0 else 0.0,
+        }
+
+
+class Replayer(object):
+    """
+    Replayer plays a recording made by RecordingTransport back through the transport of a client.
+
+    Calls are made at the recorded times with the gaps between them divided by `speed` (0 for as fast as possible),
+     by up to `concurrency` threads; calls that cannot start in time because all threads are busy are late.
+     Calls with a response are made with no_raise=True and count as failed if they got none; streamed responses
+     are read to the end.
+    """
+
+    def __init__(self, client, speed=1, concurrency=REPLAY_CONCURRENCY, progress=None, progress_interval=5):
+        """
+        :param client: Infinario client whose transport makes the calls
+        :param progress: Optional callable receiving the statistics every `progress_interval` seconds
+        """
+        if speed < 0 or concurrency < 1:
+            raise ValueError('Replayer needs a non-negative speed and at least one thread')
+        self._client = client
+        self._speed = speed
+        self._concurrency = concurrency
+        self._progress = progress
+        self._progress_interval = progress_interval
+
+    def run(self, path):
+        """
+        Replay the recording at `path`, flush the client and return the statistics of the replay.
+        """
+        calls = queue.Queue(self._concurrency * 2)
+        state = _WorkerData(
+            lock=threading.Lock(),
+            calls=0,
+            failed=0,
+            latencies=[],  # seconds of every call
+            lags=[],  # seconds every call started after its time
+            started=time.time(),
+        )
+        threads = [threading.Thread(target=self._run_caller, args=(calls, state)) for _ in range(self._concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        reported, first, started = time.time(), None, _monotonic()
+        try:
+            for recorded, kind, service, body in self._read(path):
+                if first is None:
+                    first = recorded
+                due = started + (recorded - first) / self._speed if self._speed else _monotonic()
+                wait = due - _monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                calls.put((due, kind, service, DEFAULT_SERIALIZER.loads(body)))
+                if self._progress and time.time() - reported >= self._progress_interval:
+                    reported = time.time()
+                    self._progress(self._statistics(state))
+        finally:
+            for _ in threads:
+                calls.put(None)
+            for thread in threads:
+                thread.join()
+        self._client.flush()
+        return self._statistics(state)
+
+    def _run_caller(self, calls, state):
+        transport = self._client._transport
+        latencies, lags, failed = [], [], 0
+        while True:
+            call = calls.get()
+            if call is None:
+                break
+            due, kind, service, message = call
+            started = _monotonic()
+            try:
+                if kind == RecordingTransport._RECEIVE:
+                    failed += transport.send_and_receive(service, message, no_raise=True) is None
+                elif kind == RecordingTransport._STREAM:
+                    chunks = transport.send_and_stream(service, message, no_raise=True)
+                    failed += chunks is None
+                    for _ in chunks or ():
+                        pass  # the whole response is downloaded, as by the recorded call
+                else:
+                    transport.send_and_ignore(service, message)
+            except Exception:
+                failed += 1
+            latencies.append(_monotonic() - started)
+            lags.append(max(0.0, started - due))
+
+            if len(latencies) >= 1000:
+                latencies, lags, failed = self._merge(state, latencies, lags, failed)
+        self._merge(state, latencies, lags, failed)
+
+    @staticmethod
+    def _merge(state, latencies, lags, failed):
+        with state.lock:
+            state.calls += len(latencies)
+            state.failed += failed
+            state.latencies.extend(latencies)
+            state.lags.extend(lags)
+        return [], [], 0
+
+    @staticmethod
+    def _read(path):
+        """
+        Yield the recorded (time, kind, service, encoded message) in the order of time.
+        """
+        header = RecordingTransport._RECORD
+        with open(path, 'rb') as recording:
+            size = os.fstat(recording.fileno()).st_size
+            if size == 0:
+                return
+            data = mmap.mmap(recording.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                index, offset = [], 0
+                while offset + header.size <= size:
+                    recorded, _, kind, service_length, length = header.unpack_from(data, offset)
+                    if offset + header.size + service_length + length > size:
+                        break  # torn write of the last record
+                    index.append((recorded, offset))
+                    offset += header.size + service_length + length
+
+                # records of several threads or processes are not necessarily in the order of time
+                index.sort()
+                for recorded, offset in index:
+                    _, _, kind, service_length, length = header.unpack_from(data, offset)
+                    offset += header.size
+                    service = data[offset:offset + service_length].decode('utf-8')
+                    offset += service_length
+                    yield recorded, kind, service, data[offset:offset + length]
+            finally:
+                data.close()
+
+    @staticmethod
+    def _statistics(state):
+        with state.lock:
+            latencies, lags = sorted(state.latencies), sorted(state.lags)
+            calls, failed = state.calls, state.failed
+        seconds = time.time() - state.started
+
+        def percentile(values, fraction):
+            return values[int(round(fraction * (len(values) - 1)))] if values else 0.0
+
+        return {
+            'calls': calls,
+            'failed': failed,
+            'seconds': seconds,
+            'calls_per_second': calls / seconds if seconds > 0 else 0.0,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p90': percentile(latencies, 0.9),
+            'latency_p99': percentile(latencies, 0.99),
+            'latency_max': latencies[-1] if latencies else 0.0,
+            'lag_p99': percentile(lags, 0.99),
+        }
+
+
+class _TableJSONParser(object):
+    """
+    Incremental parser of `table-json` exports: the rows of the `rows` array are parsed one by one as the text
+     arrives, other members of the top-level object are kept in `fields`.
+    """
+
+    _SEPARATORS = re.compile(r'[\s,:]*')
+
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self._decoder = json.JSONDecoder()
+        self._buffer = u('')
+        self._state = 'start'
+        self._key = None
+
+    def feed(self, text):
+        """
+        Parse the next piece of the text, yielding the header and the rows completed by it.
+        """
+        buffer, position = self._buffer + text, 0
+        while not self.done:
+            position = self._SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if self._state == 'start':
+                if char != '{':
+                    raise ValueError('Infinario analysis export is not a JSON object')
+                self._state = 'key'
+                position += 1
+            elif char == '}' and self._state == 'key':
+                self.done = True
+                position += 1
+            elif char == ']' and self._state == 'rows':
+                self._state = 'key'
+                position += 1
+            elif char == '[' and self._state == 'value' and self._key == 'rows':
+                self._state = 'rows'
+                position += 1
+            else:
+                try:
+                    value, end = self._decoder.raw_decode(buffer, position)
+                except ValueError:
+                    break  # incomplete
+                if end == len(buffer):
+                    break  # a number might continue in the next piece
+                position = end
+                if self._state == 'rows':
+                    yield value
+                elif self._state == 'key':
+                    self._key, self._state = value, 'value'
+                else:
+                    self.fields[self._key], self._state = value, 'key'
+                    if self._key == 'header':
+                        yield value
+        self._buffer = buffer[position:]
+
+
+def _table_json_rows(chunks, errors):
+    parser = _TableJSONParser()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        for row in parser.feed(decoder.decode(chunk)):
+            yield row
+    if not parser.done or not parser.fields.get('success', True):
+        errors.handle(u('Infinario API analysis export failed with errors: {0}').format(
+            str(parser.fields.get('errors', ['incomplete response']))
+        ), InvalidRequest)
+
+
+def _text_lines(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = u('')
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', True)
+    if pending:
+        yield pending
+
+
+def _read_import_records(paths, file_format=None):
+    """
+    Lazily read records from JSONL or CSV files (by extension, unless given), `-` reads JSONL from stdin.
+    """
+    for path in paths:
+        stream = sys.stdin if path == '-' else io.open(path, encoding='utf-8', newline='')
+        try:
+            if (file_format or ('csv' if path.endswith('.csv') else 'jsonl')) == 'csv':
+                for row in csv.DictReader(stream):
+                    yield row
+            else:
+                for line in stream:
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+
 def _add_common_arguments(parser):
     parser.add_argument('token')
     parser.add_argument('registered_customer_id')
@@ -410,6 +2959,7 @@ def _add_common_arguments(parser):
 
 
 if __name__ == '__main__':
+    import signal
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
@@ -430,6 +2980,37 @@ if __name__ == '__main__':
     def get_html():
         print(client.get_html(args.html_campaign_name))
 
+    def report(statistics):
+        print(u('Imported {records} records ({commands} commands, {failed} failed) in {seconds:.1f} s, '
+                '{commands_per_second:.0f} commands/s').format(**statistics), file=sys.stderr)
+
+    def collect():
+        collector = SidecarCollector(args.target, args.socket, silent=False, transport=functools.partial(
+            AsynchronousTransport, workers=args.workers, bulk_max_size=args.bulk_size))
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_args: collector.stop())
+        collector.serve_forever()
+
+    def replay():
+        transports = {'sync': SynchronousTransport, 'http-client': HTTPClientTransport,
+                      'async': functools.partial(AsynchronousTransport, workers=args.concurrency)}
+        replay_client = Infinario(None, target=args.target, secret=args.secret, transport=transports[args.transport])
+        replayer = Replayer(replay_client, speed=args.speed, concurrency=args.concurrency, progress=replayed)
+        try:
+            replayed(replayer.run(args.recording))
+        finally:
+            replay_client.close()
+
+    def replayed(statistics):
+        print(u('Replayed {calls} calls ({failed} failed) in {seconds:.1f} s, {calls_per_second:.0f} calls/s, latency '
+                'p50 {latency_p50:.4f} s, p90 {latency_p90:.4f} s, p99 {latency_p99:.4f} s, max {latency_max:.4f} s, '
+                'lag p99 {lag_p99:.4f} s').format(**statistics), file=sys.stderr)
+
+    def import_records():
+        importer = BulkImporter(client, kind=args.kind, connections=args.connections, bulk_size=args.bulk_size,
+                                checkpoint=args.checkpoint, progress=report)
+        report(importer.run(_read_import_records(args.files, args.format)))
+
     parser_track = commands.add_parser('track', help='Track event')
     _add_common_arguments(parser_track)
     parser_track.add_argument('event_type')
@@ -446,7 +3027,36 @@ if __name__ == '__main__':
     parser_get_html.add_argument('html_campaign_name')
     parser_get_html.set_defaults(func=get_html)
 
+    parser_import = commands.add_parser('import', help='Import events or customer updates from JSONL or CSV files')
+    parser_import.add_argument('token')
+    parser_import.add_argument('files', nargs='*', default=['-'], help='files to import, - for stdin')
+    parser_import.add_argument('--target', default=DEFAULT_TARGET, metavar='URL')
+    parser_import.add_argument('--kind', choices=['events', 'customers'], default='events')
+    parser_import.add_argument('--format', choices=['jsonl', 'csv'], help='default by file extension')
+    parser_import.add_argument('--connections', type=int, default=IMPORT_CONNECTIONS)
+    parser_import.add_argument('--bulk-size', type=int, default=IMPORT_BULK_SIZE)
+    parser_import.add_argument('--checkpoint', metavar='FILE', help='resume from and save progress to this file')
+    parser_import.set_defaults(func=import_records)
+
+    parser_collector = commands.add_parser('collector', help='Collect commands of local SidecarTransports into bulks')
+    parser_collector.add_argument('--socket', metavar='PATH')
+    parser_collector.add_argument('--target', default=DEFAULT_TARGET, metavar='URL')
+    parser_collector.add_argument('--workers', type=int, default=ASYNC_WORKERS)
+    parser_collector.add_argument('--bulk-size', type=int, default=SIDECAR_BULK_SIZE)
+    parser_collector.set_defaults(func=collect)
+
+    parser_replay = commands.add_parser('replay', help='Replay a recording of RecordingTransport')
+    parser_replay.add_argument('recording')
+    parser_replay.add_argument('--target', default=DEFAULT_TARGET, metavar='URL')
+    parser_replay.add_argument('--secret')
+    parser_replay.add_argument('--transport', choices=['sync', 'http-client', 'async'], default='sync')
+    parser_replay.add_argument('--speed', type=float, default=1, help='1 for recorded pace, N times faster, 0 for max')
+    parser_replay.add_argument('--concurrency', type=int, default=REPLAY_CONCURRENCY)
+    parser_replay.set_defaults(func=replay)
+
     args = parser.parse_args()
 
-    client = Infinario(args.token, customer=args.registered_customer_id, target=args.target, silent=False)
+    if args.func not in (collect, replay):
+        client = Infinario(args.token, customer=getattr(args, 'registered_customer_id', None), target=args.target,
+                           silent=False)
     args.func()
@@ -0,0 +1,772 @@
+#!/usr/bin/env python
+"""
+Asyncio support for the Infinario Python SDK (requires Python 3.5+).
+
+    client = AsyncInfinario('12345678-90ab-cdef-1234-567890abcdef', customer='john123')
+    await client.track('purchase', {'product': 'bottle'})
+    segment = await client.get_segment('11112222-3333-4444-5555-666677778888')
+    await client.close()
+"""
+
+import asyncio
+import codecs
+import collections
+import csv
+import itertools
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from infinario import (CircuitBreaker, Infinario, InvalidRequest, RetryPolicy, ServiceUnavailable, _BufferedCommand,
+                       _Response, _TableJSONParser, _UpdateCoalescer, _apply_retry_policy, _bulk_failure,
+                       _compress, _dead_letter, _encode_bulk, _handle_response, _sort_bulk, u,
+                       ASYNC_BUFFER_MAX_SIZE, ASYNC_BUFFER_TIMEOUT, ASYNC_BULK_MAX_BYTES, COMPRESSION_THRESHOLD,
+                       DEFAULT_SERIALIZER, EXPORT_BATCH_SIZE, EXPORT_CHUNK_SIZE, SEGMENTS_WORKERS)
+
+
+ASYNCIO_POOL_SIZE = 100  # max number of concurrent keep-alive connections of one transport
+
+
+class _StaleConnection(Exception):
+    pass
+
+
+class _ConnectionPool(object):
+    """
+    Minimal HTTP/1.1 client keeping up to `size` keep-alive connections to the target open.
+    """
+
+    def __init__(self, target, size):
+        parts = urlsplit(target)
+        self._secure = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port or (443 if self._secure else 80)
+        self._host_header = parts.netloc
+        self._prefix = parts.path or '/'
+        self._size = size
+        self._idle = []
+        self._semaphore = None
+        self._ssl_context = None
+
+    async def post(self, service, body, headers, stream=False):
+        """
+        Send a request and return the _Response, or with `stream` a _StreamedBody if the status is 200.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._size)
+
+        request = self._format_request(service, body, headers)
+        response = None
+        # a streamed body holds its connection until it was read
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                reader, writer = self._idle.pop()
+                try:
+                    response = await self._exchange(reader, writer, request, stream)
+                    return response
+                except (_StaleConnection, ConnectionError):
+                    pass  # keep-alive connection was closed by the server in the meantime, try another one
+
+            reader, writer = await self._connect()
+            try:
+                response = await self._exchange(reader, writer, request, stream)
+                return response
+            except _StaleConnection:
+                raise ConnectionResetError('Connection closed without a response')
+        finally:
+            if not isinstance(response, _StreamedBody):
+                self._semaphore.release()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    def _format_request(self, service, body, headers):
+        lines = ['POST {0}{1} HTTP/1.1'.format(self._prefix, service),
+                 'Host: {0}'.format(self._host_header),
+                 'Content-Length: {0}'.format(len(body)),
+                 'Connection: keep-alive']
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+    async def _connect(self):
+        if not self._secure:
+            return await asyncio.open_connection(self._host, self._port)
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return await asyncio.open_connection(
+            self._host, self._port, ssl=self._ssl_context, server_hostname=self._host)
+
+    async def _exchange(self, reader, writer, request, stream=False):
+        try:
+            writer.write(request)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise _StaleConnection()
+            version, status = status_line.split(None, 2)[:2]
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+            if stream and int(status) == 200:
+                length = None if chunked or 'content-length' not in headers else int(headers['content-length'])
+                return _StreamedBody(self, reader, writer, chunked, length,
+                                     keep_alive and (chunked or length is not None))
+            if chunked:
+                content = await self._read_chunked(reader)
+            elif 'content-length' in headers:
+                content = await reader.readexactly(int(headers['content-length']))
+            else:
+                content = await reader.read()
+                keep_alive = False
+        except BaseException:
+            # includes cancellation by a timeout - the connection is in an unknown state
+            writer.close()
+            raise
+
+        self._release(reader, writer, keep_alive)
+        return _Response(int(status), content)
+
+    def _release(self, reader, writer, reusable):
+        if reusable and len(self._idle) < self._size:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass  # trailers
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+
+class _StreamedBody(object):
+    """
+    Async iterator of the chunks of a response body of at most `chunk_size` bytes, read as they are downloaded
+     with at most `timeout` seconds for each. The connection goes back to the pool once the body was read
+     completely; a body that is not read to the end must be closed.
+    """
+
+    status_code = 200  # other responses are not streamed
+
+    def __init__(self, pool, reader, writer, chunked, length, keep_alive):
+        self.chunk_size = EXPORT_CHUNK_SIZE
+        self.timeout = None
+        self._pool = pool
+        self._reader = reader
+        self._writer = writer
+        self._chunked = chunked
+        # bytes left of the body, or of the current chunk if chunked; None until the end of the stream or chunk
+        self._remaining = length
+        self._keep_alive = keep_alive
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            chunk = await asyncio.wait_for(self._read(), self.timeout)
+        except BaseException:
+            self.close()
+            raise
+        if not chunk:
+            self.close(complete=True)
+            raise StopAsyncIteration
+        return chunk
+
+    async def _read(self):
+        reader = self._reader
+        if self._chunked and not self._remaining:
+            if self._remaining == 0:
+                await reader.readexactly(2)  # end of the previous chunk
+            self._remaining = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if self._remaining == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass  # trailers
+                return b''
+        if self._remaining is None:
+            return await reader.read(self.chunk_size)
+        if self._remaining == 0:
+            return b''
+        chunk = await reader.read(min(self.chunk_size, self._remaining))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b'', self._remaining)
+        self._remaining -= len(chunk)
+        return chunk
+
+    def close(self, complete=False):
+        if self._closed:
+            return
+        self._closed = True
+        self._pool._release(self._reader, self._writer, complete and self._keep_alive)
+        self._pool._semaphore.release()
+
+
+class _CSVParser(object):
+    """
+    Incremental parser of `csv` exports, see _TableJSONParser: a record is parsed once a line break outside
+     of a quoted value ends it.
+    """
+
+    def __init__(self):
+        self._pending = u('')  # text after the last line break
+        self._record = []  # lines of the current record
+        self._quotes = 0
+
+    def feed(self, text, final=False):
+        """
+        Parse the next piece of the text, returning the rows completed by it; with `final`, also the last row.
+        """
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        if final and self._pending:
+            lines.append(self._pending)
+            self._pending = u('')
+
+        records = []
+        for i, line in enumerate(lines):
+            self._record.append(line if final and i == len(lines) - 1 else line + '\n')
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:  # quotes in quoted values are doubled
+                records.extend(self._record)
+                self._record, self._quotes = [], 0
+        if final:
+            records.extend(self._record)
+            self._record = []
+        return list(csv.reader(records))
+
+
+class _AsyncRows(object):
+    """
+    Async iterator of the rows of a streamed analysis export, see AsyncInfinario.export_rows.
+    """
+
+    def __init__(self, transport, errors, service, data, timeout):
+        self._transport = transport
+        self._errors = errors
+        self._service = service
+        self._data = data
+        self._timeout = timeout
+        self._csv = data['format'] == 'csv'
+        self._parser = _CSVParser() if self._csv else _TableJSONParser()
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._rows = collections.deque()
+        self._chunks = None  # the chunks of the response once requested, False once finished
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._rows:
+            if self._chunks is False:
+                raise StopAsyncIteration
+            if self._chunks is None:
+                self._chunks = await self._transport.send_and_stream(self._service, self._data, timeout=self._timeout)
+                if self._chunks is None:
+                    self._chunks = False
+                continue
+
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._chunks = False
+                self._finish()
+                continue
+            try:
+                self._rows.extend(self._parser.feed(self._decoder.decode(chunk)))
+            except BaseException:
+                # a body that cannot be parsed is not read further, its connection must go back to the pool
+                self.close()
+                raise
+        return self._rows.popleft()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.aclose()
+
+    def _finish(self):
+        text = self._decoder.decode(b'', True)
+        if self._csv:
+            self._rows.extend(self._parser.feed(text, final=True))
+            return
+        self._rows.extend(self._parser.feed(text))
+        if not self._parser.done or not self._parser.fields.get('success', True):
+            self._errors.handle(u('Infinario API analysis export failed with errors: {0}').format(
+                str(self._parser.fields.get('errors', ['incomplete response']))
+            ), InvalidRequest)
+
+    def close(self):
+        """
+        Stop reading the export before its end.
+        """
+        if self._chunks:
+            self._chunks.close()
+        self._chunks = False
+        self._rows.clear()
+
+    async def aclose(self):
+        self.close()
+
+
+class _AsyncColumns(object):
+    """
+    Async iterator of the column batches of a streamed analysis export, see AsyncInfinario.export_columns.
+    """
+
+    def __init__(self, rows, batch_size):
+        self._rows = rows
+        self._batch_size = batch_size
+        self._header = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._header is None:
+            self._header = await self._rows.__anext__()
+        batch = []
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(await self._rows.__anext__())
+            except StopAsyncIteration:
+                break
+        if not batch:
+            raise StopAsyncIteration
+        return dict(zip(self._header, (list(column) for column in zip(*batch))))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.aclose()
+
+    def close(self):
+        """
+        Stop reading the export before its end.
+        """
+        self._rows.close()
+
+    async def aclose(self):
+        self.close()
+
+
+class _AsyncBulkResults(object):
+    """
+    Async iterator of the results of AsyncInfinario.track_many and update_many, sending a bulk request
+     whenever the results of the previous one are consumed.
+    """
+
+    def __init__(self, transport, items, command, bulk_size):
+        self._transport = transport
+        self._items = iter(items)
+        self._command = command
+        self._bulk_size = bulk_size
+        self._results = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._results:
+            chunk = list(itertools.islice(self._items, self._bulk_size))
+            if not chunk:
+                raise StopAsyncIteration
+
+            results, commands, sent = Infinario._many_commands(chunk, self._command)
+            if commands:
+                response = await self._transport.send_and_receive('bulk', {'commands': commands}, no_raise=True)
+                Infinario._many_results(chunk, results, sent, response)
+            self._results.extend(results)
+        return self._results.popleft()
+
+
+class AsyncioTransport(object):
+    """
+    AsyncioTransport is a buffered transport for asyncio applications using a pool of keep-alive connections.
+     This transport requires that the close coroutine is awaited once the client will no longer be used.
+
+    All methods are coroutines. Commands sent by send_and_ignore are buffered up to `bulk_max_size` of commands
+     or `bulk_max_bytes` of encoded commands and flushed by a background task at most after ASYNC_BUFFER_TIMEOUT
+     seconds; with buffered=False they are sent right away. At most pool_size requests are in flight at the same time.
+    Messages are encoded and responses decoded by the `serializer`, DEFAULT_SERIALIZER if not given.
+    With `compression` ('gzip' or 'deflate'), request bodies of at least `compression_threshold` bytes are compressed.
+    Commands the API asks to retry, and commands of failed bulk requests, are retried according to the
+     `retry_policy` as in AsynchronousTransport. Requests fail fast while the `circuit_breaker` is open,
+     see SynchronousTransport.
+    With `coalesce_updates`, buffered customer updates are merged as in AsynchronousTransport.
+    """
+
+    def __init__(self, target, errors, secret=None, pool_size=ASYNCIO_POOL_SIZE, buffered=True, serializer=None,
+                 bulk_max_size=ASYNC_BUFFER_MAX_SIZE, bulk_max_bytes=ASYNC_BULK_MAX_BYTES,
+                 compression=None, compression_threshold=COMPRESSION_THRESHOLD, retry_policy=None,
+                 circuit_breaker=None, coalesce_updates=False):
+        if compression not in (None, 'gzip', 'deflate'):
+            raise ValueError('Unknown compression {0!r}'.format(compression))
+        self._errors = errors
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._circuit_breaker = CircuitBreaker.for_target(target) if circuit_breaker is None else circuit_breaker
+        self._serializer = serializer or DEFAULT_SERIALIZER
+        self._bulk_max_size = bulk_max_size
+        self._bulk_max_bytes = bulk_max_bytes
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._target = target
+        self._pool = _ConnectionPool(target, pool_size)
+        self._headers = {'Content-type': 'application/json'}
+        if secret:
+            self._headers['X-Infinario-Secret'] = secret
+        self._buffered = buffered
+        self._buffer = collections.deque()
+        self._buffered_bytes = 0
+        self._backoff_until = 0  # time before which no bulk is sent after a retry
+        self._in_flight = 0  # bulks taken from the buffer and not answered yet
+        self._coalescer = _UpdateCoalescer(self._serializer) if coalesce_updates else None
+        self._task = None
+        self._wakeup = None
+        self._drained = None
+        self._flush = False
+        self._stop = False
+
+    async def _send(self, service, message, no_raise=False, timeout=None):
+        return await self._post(service, self._serializer.dumps(message), no_raise=no_raise, timeout=timeout)
+
+    async def _post(self, service, body, no_raise=False, timeout=None, stream=False):
+        headers = self._headers
+        body, encoding = _compress(body, self._compression, self._compression_threshold)
+        if encoding is not None:
+            headers = dict(headers, **{'Content-Encoding': encoding})
+        breaker = self._circuit_breaker
+        if breaker and not breaker.allow():
+            return self._errors.handle(
+                u('Infinario API at {0} is unavailable, request to {1} not sent').format(self._target, service),
+                ServiceUnavailable, no_raise=no_raise)
+        try:
+            response = await asyncio.wait_for(self._pool.post(service, body, headers, stream), timeout)
+        except asyncio.TimeoutError:
+            return self._errors.handle(
+                u('Infinario request to {0} failed to complete within timeout {1}').format(service, timeout),
+                ServiceUnavailable, no_raise=no_raise)
+        except (OSError, asyncio.IncompleteReadError):
+            if breaker:
+                breaker.record_failure()
+            return self._errors.handle(
+                u('Failed connecting to Infinario API at the given target URL {0}').format(self._target),
+                ServiceUnavailable, no_raise=no_raise)
+
+        if breaker:
+            if response.status_code in (503, 504):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        if isinstance(response, _StreamedBody):
+            return response
+        return _handle_response(self._errors, response, no_raise=no_raise, serializer=self._serializer)
+
+    async def send_and_receive(self, service, message, no_raise=False, timeout=None):
+        # always non-silent, as the result is used
+        return await self._send(service, message, no_raise=no_raise, timeout=timeout)
+
+    async def send_and_stream(self, service, message, no_raise=False, timeout=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Send a message and return an async iterator of the chunks of the response body as they are downloaded,
+         None if the request failed. An iterator that is not read to the end must be closed.
+        """
+        response = await self._post(service, self._serializer.dumps(message), no_raise=no_raise, timeout=timeout,
+                                    stream=True)
+        if not isinstance(response, _StreamedBody):
+            return None
+        response.chunk_size, response.timeout = chunk_size, timeout
+        return response
+
+    async def send_and_ignore(self, service, message):
+        if self._stop:
+            raise ValueError('The API is already closed')
+        if not self._buffered:
+            await self._send(service, message)
+            return
+
+        self._ensure_flusher()
+        scheduled = time.time()
+        entry = _BufferedCommand(
+            self._serializer.dumps({'name': service, 'data': message, 'scheduled': scheduled}), scheduled)
+        if service == 'crm/customers' and self._coalescer is not None:
+            entry.update = _UpdateCoalescer.key(message)
+            merged = self._coalescer.merge(entry, message)
+            if merged is not None:
+                self._buffered_bytes += merged[1]
+                return
+        self._buffer.append(entry)
+        self._buffered_bytes += len(entry.encoded)
+        if len(self._buffer) == 1 or self._bulk_ready():
+            self._wakeup.set()
+
+    def _bulk_ready(self):
+        return len(self._buffer) > self._bulk_max_size or self._buffered_bytes >= self._bulk_max_bytes
+
+    def _ensure_flusher(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._drained = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run_flusher())
+
+    async def _run_flusher(self):
+        while True:
+            # the same loop as in _Worker.run
+            size = len(self._buffer)
+            backoff_in = self._backoff_until - time.time() if size > 0 and not self._stop else None
+            timeout_in = self._buffer[0].scheduled + ASYNC_BUFFER_TIMEOUT - time.time() if size > 0 else None
+            timeouted = timeout_in is not None and timeout_in < 0
+
+            if backoff_in is not None and backoff_in > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), backoff_in)
+                except asyncio.TimeoutError:
+                    pass
+            elif (size > 0 and self._flush) or self._bulk_ready() or timeouted:
+                try:
+                    await self._send_bulk()
+                except Exception as e:
+                    # the task must keep running, otherwise flush and close would wait for it forever
+                    self._errors.handle(u('Infinario bulk request failed: {0!r}').format(e), ServiceUnavailable,
+                                        no_raise=True)
+                    await asyncio.sleep(ASYNC_BUFFER_TIMEOUT)
+                if len(self._buffer) == 0 and self._in_flight == 0:
+                    self._flush = False
+                    self._drained.set()
+            else:
+                if self._stop:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout_in)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send_bulk(self):
+        selected, size = [], 0
+        while self._buffer and len(selected) < self._bulk_max_size and \
+                (not selected or size + len(self._buffer[0].encoded) <= self._bulk_max_bytes):
+            entry = self._buffer.popleft()
+            if self._coalescer is not None:
+                self._coalescer.taken(entry)
+            selected.append(entry)
+            size += len(entry.encoded)
+        self._buffered_bytes -= size
+
+        self._in_flight += 1
+        try:
+            # there is no caller to raise to in the background task, failures are always only logged
+            response = await self._post('bulk', _encode_bulk([entry.encoded for entry in selected]), no_raise=True)
+        finally:
+            self._in_flight -= 1
+        outcome = _sort_bulk(selected, response)
+        if outcome is None:
+            self._retry(selected)
+            return
+
+        _, leftovers, failed = outcome
+        for _, status, errors in failed:
+            self._errors.handle(_bulk_failure(status, errors), ServiceUnavailable, no_raise=True)
+        self._retry(leftovers)
+
+    def _retry(self, entries):
+        """
+        Put commands back at the head of the buffer and hold back the next bulk, see _Worker._retry.
+        """
+        retried, exhausted, due = _apply_retry_policy(self._retry_policy, entries, time.time())
+        if retried:
+            self._buffer.extendleft(reversed(retried))
+            self._buffered_bytes += sum(len(entry.encoded) for entry in retried)
+            self._backoff_until = max(self._backoff_until, due)
+        if exhausted:
+            _dead_letter(self._retry_policy, [self._serializer.loads(entry.encoded) for entry in exhausted],
+                         'retries exhausted', self._errors)
+
+    async def flush(self, timeout=None):
+        """
+        Wait until the buffered commands are sent or given up according to the retry policy,
+         at most `timeout` seconds.
+        """
+        if self._task is None or self._task.done() or (len(self._buffer) == 0 and self._in_flight == 0):
+            return
+        self._flush = True
+        self._drained.clear()
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def stop(self):
+        self._stop = True
+        if self._task is not None:
+            self._flush = True
+            self._wakeup.set()
+            await self._task
+        self._pool.close()
+
+
+class AsyncInfinario(Infinario):
+    """
+    Infinario API access for asyncio applications, see class Infinario.
+    All methods are coroutines, except track_many, update_many, export_rows and export_columns returning
+     async iterators, and the client must be closed when no more data is to be tracked.
+    """
+
+    def __init__(self, token,
+                 customer=None, target=None, silent=True, logger=None, transport=AsyncioTransport, secret=None):
+        """
+        :param transport: `AsyncioTransport` or another transport with coroutine methods
+        See class Infinario for the other parameters.
+        """
+        super(AsyncInfinario, self).__init__(token, customer=customer, target=target, silent=silent, logger=logger,
+                                             transport=transport, secret=secret)
+
+    def _create_transport(self, transport, errors, secret):
+        return transport(self._target, errors, secret=secret)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.close()
+
+    async def identify(self, customer=None, properties=None):
+        self._customer = self._convert_customer_argument(customer)
+        if properties is not None:
+            await self.update(properties)
+
+    async def update(self, properties):
+        await self._update(self._customer, properties)
+
+    async def track(self, event_type, properties=None, timestamp=None):
+        await self._track(self._customer, event_type, properties, timestamp)
+
+    async def get_html(self, html_campaign_name):
+        return await self._get_html(self._customer, html_campaign_name)
+
+    async def export_analysis(self, analysis_type, data):
+        return await self._transport.send_and_receive('analytics/{0}'.format(analysis_type), data)
+
+    async def get_segment(self, segmentation_id, timezone='UTC', timeout=0.5):
+        return await self._get_segment(self._customer, segmentation_id, timezone, timeout)
+
+    async def get_segments(self, segmentation_id, customers, timezone='UTC', deadline=1, workers=SEGMENTS_WORKERS):
+        expires = time.monotonic() + deadline
+        keys, pending = {}, collections.OrderedDict()
+        for customer in customers:
+            converted = self._convert_customer_argument(customer)
+            key = self._customer_key(converted)
+            keys[customer if isinstance(customer, str) else key] = key
+            pending.setdefault(key, converted)
+
+        semaphore = asyncio.Semaphore(workers)
+
+        async def load(customer):
+            async with semaphore:
+                timeout = expires - time.monotonic()
+                if timeout <= 0:
+                    return None
+                return await self._get_segment(customer, segmentation_id, timezone, timeout)
+
+        tasks = dict((key, asyncio.ensure_future(load(customer))) for key, customer in pending.items())
+        results = {}
+        if tasks:
+            done, unfinished = await asyncio.wait(list(tasks.values()), timeout=max(0, expires - time.monotonic()))
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.gather(*unfinished, return_exceptions=True)
+            for key, task in tasks.items():
+                if task in done:
+                    results[key] = task.result()  # raises unless silent, as get_segment
+        return dict((customer, results.get(key)) for customer, key in keys.items())
+
+    def export_rows(self, analysis_type, data, timeout=None):
+        """
+        Export the result of an analysis as an async iterator of rows, see Infinario.export_rows.
+        The request is sent once the iteration starts; an iterator that is not read to the end must be closed.
+        """
+        data = dict(data)
+        export_format = data.setdefault('format', 'table-json')
+        if export_format not in ('table-json', 'csv'):
+            raise ValueError('Analysis export format {0!r} cannot be streamed'.format(export_format))
+        return _AsyncRows(self._transport, self._error_handler, 'analytics/{0}'.format(analysis_type), data, timeout)
+
+    def export_columns(self, analysis_type, data, batch_size=EXPORT_BATCH_SIZE, timeout=None):
+        """
+        Export the result of an analysis as an async iterator of column batches, see Infinario.export_columns.
+        """
+        return _AsyncColumns(self.export_rows(analysis_type, data, timeout=timeout), batch_size)
+
+    def track_many(self, events, bulk_size=ASYNC_BUFFER_MAX_SIZE):
+        """
+        Track events of many customers in bulk requests, see Infinario.track_many.
+        The events are read and sent one bulk at a time as the results are iterated.
+        :return: Async iterator of BulkResult(item, status, errors) for every event in the given order
+        """
+        return _AsyncBulkResults(self._transport, events, self._event_command, bulk_size)
+
+    def update_many(self, updates, bulk_size=ASYNC_BUFFER_MAX_SIZE):
+        """
+        Update the properties of many customers in bulk requests, see Infinario.update_many.
+        :return: Async iterator of BulkResult(item, status, errors) for every update in the given order
+        """
+        return _AsyncBulkResults(self._transport, updates, self._update_command, bulk_size)
+
+    async def _update(self, customer, properties):
+        await self._transport.send_and_ignore('crm/customers', self._update_message(customer, properties))
+
+    async def _track(self, customer, event_type, properties, timestamp):
+        await self._transport.send_and_ignore('crm/events',
+                                              self._track_message(customer, event_type, properties, timestamp))
+
+    async def _get_html(self, customer, html_campaign_name):
+        response = await self._transport.send_and_receive('campaigns/html/get',
+                                                          self._html_message(customer, html_campaign_name))
+        return response['data']
+
+    async def _get_segment(self, customer, segmentation_id, timezone, timeout):
+        try:
+            result = await self._transport.send_and_receive(
+                'analytics/segmentation-for', self._segment_message(customer, segmentation_id, timezone, timeout),
+                no_raise=True, timeout=timeout)
+        except ServiceUnavailable:
+            return None
+
+        return self._segment_from_result(result)
+
+    async def flush(self, timeout=None):
+        """
+        Wait until the buffered data is sent or given up, at most `timeout` seconds if given.
+        """
+        flush = getattr(self._transport, 'flush', None)
+        if flush is not None:
+            await (flush() if timeout is None else flush(timeout=timeout))
+
+    async def close(self):
+        stop = getattr(self._transport, 'stop', None)
+        if stop is not None:
+            await stop()
@@ -4,9 +4,10 @@ from setuptools import setup
 
 setup(
     name='infinario',
-    py_modules=['infinario'],
+    py_modules=['infinario', 'infinario_asyncio'],
     version='2.0.1',
     install_requires=['requests>=2.2.1'],
+    extras_require={'orjson': ['orjson']},
     description='Infinario Python SDK',
     url='https://github.com/infinario/python-sdk',
     author='Peter Dolak',
@@ -1,16 +1,104 @@
 import json
+import os
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import time
+import zlib
 if sys.version_info < (3, ):
     import unittest2 as unittest
 else:
     import unittest
 import re
+import threading
+import functools
+import itertools
 import requests
-from infinario import Infinario, SynchronousTransport
+from infinario import Infinario, SynchronousTransport, AsynchronousTransport, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+from infinario import BulkImporter, NullTransport, ResultCache, SERIALIZERS, _read_import_records
+from infinario import AdaptiveBatching, CircuitBreaker, Metrics, RetryPolicy, ServiceUnavailable
+from infinario import SidecarCollector, SidecarTransport, TrackingPolicy, PRIORITY_HIGH, PRIORITY_LOW, SIDECAR_BULK_SIZE
+from infinario import HTTPClientTransport, RecordingTransport, Replayer
 try:
     from mock import MagicMock, patch
 except ImportError:
     from unittest.mock import MagicMock, patch
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+if sys.version_info >= (3, 5):
+    import asyncio
+    from infinario_asyncio import AsyncInfinario, AsyncioTransport
+
+
+class StandInAPI(object):
+    """
+    Local stand-in for the Infinario API recording all requests it receives as (service, message, headers).
+    """
+
+    def __init__(self, respond=None):
+        self.requests = []
+        self.respond = respond or self.ok
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                service = self.path.lstrip('/')
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                encoding = self.headers.get('Content-Encoding')
+                if encoding:
+                    body = zlib.decompress(body, 31 if encoding == 'gzip' else zlib.MAX_WBITS)
+                message = json.loads(body.decode('utf-8'))
+                api.requests.append((service, message, dict(self.headers)))
+                status, response = api.respond(service, message)
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                api.requests.append(('HEAD', None, dict(self.headers)))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *_args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                if not isinstance(sys.exc_info()[1], (socket.error, OSError)):
+                    HTTPServer.handle_error(self, request, client_address)
+                # otherwise the client went away, e.g. after its timeout
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.target = 'http://127.0.0.1:{0}/'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def ok(service, message):
+        if service == 'bulk':
+            return 200, {'success': True, 'results': [{'status': 'ok'} for _ in message['commands']]}
+        if service == 'analytics/segmentation-for':
+            return 200, {'success': True, 'segment': 'Heavy payer'}
+        return 200, {'success': True, 'data': '<img />'}
 
 
 class TestInfinarioSDK(unittest.TestCase):
@@ -76,3 +164,1112 @@ class TestConvertTimestampArgument(unittest.TestCase):
     def test_other(self):
         with self.assertRaisesRegex(ValueError, 'Cannot convert \'a string\' to timestamp'):
             Infinario._convert_timestamp_argument('a string')
+
+
+class TestCustomerHandles(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI()
+        self.addCleanup(self.api.close)
+
+    def test_concurrent_handles(self):
+        client = Infinario('t', target=self.api.target)
+
+        def track(number):
+            customer = client.customer('c{0}'.format(number))
+            for i in range(10):
+                customer.track('e', {'number': number})
+            customer.update({'number': number})
+
+        threads = [threading.Thread(target=track, args=(number,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(88, len(self.api.requests))
+        for service, message, _ in self.api.requests:
+            ids = message['customer_ids'] if service == 'crm/events' else message['ids']
+            self.assertEqual({'registered': 'c{0}'.format(message['properties']['number'])}, ids)
+        self.assertEqual({}, client._customer)
+
+    def test_handle_is_immutable(self):
+        ids = {'registered': 'joe'}
+        customer = Infinario('t', transport=NullTransport).customer(ids)
+        ids['registered'] = 'john'
+        self.assertEqual({'registered': 'joe'}, customer.ids)
+        with self.assertRaises(AttributeError):
+            customer._ids = {}
+
+
+class TestBatchCalls(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI(self._respond)
+        self.addCleanup(self.api.close)
+
+    @staticmethod
+    def _respond(service, message):
+        results = []
+        for command in message['commands']:
+            number = command['data']['properties']['number']
+            results.append({'status': 'retry'} if number % 3 == 1 else {'status': 'ok'})
+        return 200, {'success': True, 'results': results}
+
+    def test_track_many(self):
+        client = Infinario('t', customer='joe', target=self.api.target)
+        events = ({'type': 'e', 'properties': {'number': i}, 'customer': 'c{0}'.format(i)} for i in range(7))
+        results = []
+        counts = client.track_many(events, bulk_size=3, on_result=results.append)
+
+        self.assertEqual({'ok': 5, 'retry': 2}, counts)
+        self.assertEqual(['ok', 'retry', 'ok', 'ok', 'retry', 'ok', 'ok'], [result.status for result in results])
+        self.assertEqual([3, 3, 1], [len(message['commands']) for _, message, _ in self.api.requests])
+        self.assertEqual({'registered': 'c5'}, self.api.requests[1][1]['commands'][2]['data']['customer_ids'])
+
+    def test_track_many_without_callback(self):
+        client = Infinario('t', customer='joe', target=self.api.target)
+        self.assertEqual({'ok': 1}, client.track_many([{'type': 'e', 'properties': {'number': 0}}]))
+        self.assertEqual(1, len(self.api.requests))
+
+    def test_update_many(self):
+        client = Infinario('t', customer='joe', target=self.api.target)
+        results = []
+        client.update_many([{'properties': {'number': 0}}, {'customer': 'c1'},
+                            {'customer': 'c2', 'properties': {'number': 2}}], on_result=results.append)
+        self.assertEqual(['ok', 'invalid', 'ok'], [result.status for result in results])
+        self.assertEqual({'customer': 'c1'}, results[1].item)
+        self.assertEqual(['crm/customers', 'crm/customers'],
+                         [command['name'] for command in self.api.requests[0][1]['commands']])
+        self.assertEqual({'registered': 'joe'}, self.api.requests[0][1]['commands'][0]['data']['ids'])
+
+        client = Infinario('t', target='http://127.0.0.1:1/', transport=functools.partial(
+            SynchronousTransport, circuit_breaker=False))
+        self.assertEqual({'failed': 1}, client.update_many([{'properties': {}}]))
+
+
+class TestStreamingExport(unittest.TestCase):
+    ROWS = [[u'c{0} "\u017elt\u00fd" [x]'.format(i), i * 1.5, None] for i in range(1000)]
+
+    def setUp(self):
+        self.api = StandInAPI(lambda service, message: (200, {
+            'success': True, 'name': 'Revenue', 'header': ['customer', 'total', 'note'], 'rows': self.ROWS}))
+        self.addCleanup(self.api.close)
+
+    def test_rows_and_columns(self):
+        client = Infinario('t', target=self.api.target, secret='s')
+        rows = client.export_rows('report', {'analysis_id': 'a1'})
+        self.assertEqual(['customer', 'total', 'note'], next(rows))
+        self.assertEqual(self.ROWS, list(rows))
+        self.assertEqual('table-json', self.api.requests[0][1]['format'])
+
+        batches = list(client.export_columns('report', {'analysis_id': 'a1'}, batch_size=300))
+        self.assertEqual([300, 300, 300, 100], [len(batch['total']) for batch in batches])
+        self.assertEqual([row[0] for row in self.ROWS[300:600]], batches[1]['customer'])
+
+        with self.assertRaises(ValueError):
+            client.export_rows('report', {'analysis_id': 'a1', 'format': 'native-json'})
+
+    def _client(self, chunks):
+        transport = MagicMock()
+        transport.send_and_stream.return_value = iter(chunks)
+        return Infinario('t', silent=False, transport=lambda *args, **kwargs: transport)
+
+    def test_rows_split_across_chunks(self):
+        body = json.dumps({'header': ['customer', 'total', 'note'], 'rows': self.ROWS[:50], 'success': True,
+                           'total': 12345}).encode('utf-8')
+        rows = self._client([body[i:i + 1] for i in range(len(body))]).export_rows('report', {})
+        self.assertEqual([['customer', 'total', 'note']] + self.ROWS[:50], list(rows))
+
+        body = u'customer,note\r\njoe,"multi\nline \u017elt\u00fd"\r\njane,x\r\n'.encode('utf-8')
+        rows = self._client([body[i:i + 3] for i in range(0, len(body), 3)]).export_rows('report', {'format': 'csv'})
+        self.assertEqual([['customer', 'note'], ['joe', u'multi\nline \u017elt\u00fd'], ['jane', 'x']], list(rows))
+
+    def test_failed_export(self):
+        rows = self._client([b'{"success": false, "errors": ["no such analysis"]}']).export_rows('report', {})
+        with self.assertRaisesRegex(Exception, 'no such analysis'):
+            list(rows)
+        rows = self._client([b'{"success": true, "header": ["a"], "rows": [[1], [2']).export_rows('report', {})
+        with self.assertRaisesRegex(Exception, 'incomplete response'):
+            list(rows)
+
+
+class TestHTTPClientTransport(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI()
+        self.addCleanup(self.api.close)
+
+    def test_requests_and_keep_alive(self):
+        client = Infinario('t', customer='joe', target=self.api.target, secret='xyz', transport=functools.partial(
+            HTTPClientTransport, compression='gzip', compression_threshold=0))
+        self.addCleanup(client.close)
+        client.track('e1')
+        self.assertEqual('<img />', client.get_html('Banner'))
+        self.assertEqual('Heavy payer', client.get_segment('s1'))
+
+        self.assertEqual(['crm/events', 'campaigns/html/get', 'analytics/segmentation-for'],
+                         [service for service, _, _ in self.api.requests])
+        self.assertTrue(all(headers['X-Infinario-Secret'] == 'xyz' and headers['Content-Encoding'] == 'gzip'
+                            for _, _, headers in self.api.requests))
+        self.assertEqual(1, len(client._transport._idle))
+
+        self.api.respond = lambda service, message: (200, {'success': True, 'header': ['a'], 'rows': [[1], [2]]})
+        self.assertEqual([['a'], [1], [2]], list(client.export_rows('report', {})))
+        self.assertEqual(1, len(client._transport._idle))
+
+    def test_errors(self):
+        self.api.respond = lambda service, message: (400, {'success': False, 'errors': ['bad']})
+        client = Infinario('t', target=self.api.target, silent=False, transport=HTTPClientTransport)
+        with self.assertRaisesRegex(Exception, 'failed with errors'):
+            client.track('e')
+
+        client = Infinario('t', target='http://127.0.0.1:1/', silent=False, transport=functools.partial(
+            HTTPClientTransport, circuit_breaker=False))
+        with self.assertRaisesRegex(ServiceUnavailable, 'Failed connecting'):
+            client.get_html('Banner')
+
+    def test_requests_is_not_imported(self):
+        script = ('import sys, infinario\n'
+                  'infinario.Infinario("t", transport=infinario.NullTransport)\n'
+                  'infinario.Infinario("t", secret="s", transport=infinario.HTTPClientTransport)\n'
+                  'assert "requests" not in sys.modules\n')
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', script], cwd=os.path.dirname(
+            os.path.abspath(__file__))))
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI(self._respond)
+        self.addCleanup(self.api.close)
+        self.delay = 0
+
+    def _respond(self, service, message):
+        time.sleep(self.delay)
+        return StandInAPI.ok(service, message)
+
+    def _count(self, service):
+        return len([request for request in self.api.requests if request[0] == service])
+
+    def test_coalescing_and_eviction(self):
+        cache = ResultCache(max_size=2)
+        client = Infinario('t', target=self.api.target, cache=cache)
+        self.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.customer('joe').get_segment('s1')))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.delay = 0
+
+        self.assertEqual(['Heavy payer'] * 10, results)
+        self.assertEqual(1, self._count('analytics/segmentation-for'))
+        self.assertEqual({'hits': 0, 'stale_hits': 0, 'misses': 1, 'coalesced': 9, 'evictions': 0, 'size': 1},
+                         cache.stats())
+
+        client.customer('john').get_html('Banner')
+        client.customer('jane').get_html('Banner')
+        client.customer('jane').get_html('Banner')
+        client.customer('joe').get_segment('s1')
+        self.assertEqual(2, cache.stats()['evictions'])
+        self.assertEqual(2, self._count('campaigns/html/get'))
+        self.assertEqual(2, self._count('analytics/segmentation-for'))
+
+    def test_stale_while_revalidate(self):
+        cache = ResultCache(ttl=0.05, stale_ttl=10)
+        client = Infinario('t', customer='joe', target=self.api.target, cache=cache)
+        self.assertEqual('<img />', client.get_html('Banner'))
+        time.sleep(0.1)
+        self.assertEqual('<img />', client.get_html('Banner'))
+        time.sleep(0.1)
+
+        self.assertEqual(2, self._count('campaigns/html/get'))
+        self.assertEqual(1, cache.stats()['stale_hits'])
+
+    def test_shared_between_projects(self):
+        cache = ResultCache()
+        clients = [Infinario(token, customer='joe', target=self.api.target, cache=cache) for token in ('t1', 't2')]
+        for client in clients:
+            client.get_html('Banner')
+            client.get_segment('s1')
+
+        self.assertEqual(['t1', 't2'], [message['project_id'] for service, message, _ in self.api.requests
+                                        if service == 'campaigns/html/get'])
+        self.assertEqual(2, self._count('analytics/segmentation-for'))
+
+    def test_failures_are_not_cached(self):
+        cache = ResultCache()
+        client = Infinario('t', customer='joe', target='http://127.0.0.1:1/', cache=cache)
+        self.assertIsNone(client.get_segment('s1'))
+        self.assertEqual(0, cache.stats()['size'])
+
+
+class TestGetSegments(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI(self._respond)
+        self.addCleanup(self.api.close)
+
+    @staticmethod
+    def _respond(service, message):
+        customer = message['customer_ids'].get('registered', 'cookie')
+        if customer == 'slow':
+            time.sleep(1)
+        return 200, {'success': True, 'segment': 'Segment of {0}'.format(customer)}
+
+    def test_deadline_and_duplicates(self):
+        client = Infinario('t', target=self.api.target)
+        customers = ['c{0}'.format(i % 20) for i in range(40)] + ['slow', {'cookie': 'x'}]
+        started = time.time()
+        segments = client.get_segments('s1', customers, deadline=0.5, workers=5)
+
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(22, len(segments))
+        self.assertEqual('Segment of c7', segments['c7'])
+        self.assertEqual('Segment of cookie', segments['{"cookie": "x"}'])
+        self.assertIsNone(segments['slow'])
+        self.assertEqual(21, len([request for request in self.api.requests if request[1]['customer_ids'] != {
+            'registered': 'slow'}]))
+        self.assertEqual({}, client.get_segments('s1', []))
+
+
+class TestAsynchronousTransport(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI()
+        self.addCleanup(self.api.close)
+
+    def _sent_event_types(self):
+        return [command['data']['type'] for service, message, _ in self.api.requests if service == 'bulk'
+                for command in message['commands']]
+
+    def test_workers_send_everything(self):
+        transport = functools.partial(AsynchronousTransport, workers=4)
+        infinario = Infinario('t', customer='joe', target=self.api.target, transport=transport)
+        for i in range(500):
+            infinario.track('e{0}'.format(i))
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual(sorted('e{0}'.format(i) for i in range(500)), sorted(self._sent_event_types()))
+        self.assertTrue(all(len(message['commands']) <= 50 for _, message, _ in self.api.requests))
+
+    def test_serializers(self):
+        for serializer in SERIALIZERS.values():
+            self.api.requests = []
+            transport = functools.partial(AsynchronousTransport, serializer=serializer)
+            infinario = Infinario('t', target=self.api.target, transport=transport)
+            infinario.track('e0', {'text': u'\u017elt\u00fd k\u00f4\u0148', 'number': 1.5, 'list': [1, None, True]})
+            infinario.close()
+            infinario._transport.join()
+
+            self.assertEqual([{'name': 'crm/events', 'data': {
+                'customer_ids': {}, 'project_id': 't', 'type': 'e0',
+                'properties': {'text': u'\u017elt\u00fd k\u00f4\u0148', 'number': 1.5, 'list': [1, None, True]}}}],
+                [{'name': command['name'], 'data': command['data']} for command in self.api.requests[0][1]['commands']])
+
+    def test_size_bounded_compressed_bulks(self):
+        for compression in ('gzip', 'deflate'):
+            self.api.requests = []
+            transport = functools.partial(AsynchronousTransport, bulk_max_size=1000, bulk_max_bytes=4000,
+                                          compression=compression, compression_threshold=2000)
+            infinario = Infinario('t', target=self.api.target, transport=transport)
+            for i in range(100):
+                infinario.track('e{0}'.format(i), {'padding': 'x' * (i % 3) * 100})
+            infinario.close()
+            infinario._transport.join()
+
+            self.assertEqual(['e{0}'.format(i) for i in range(100)], self._sent_event_types())
+            for _, message, headers in self.api.requests:
+                sizes = [len(json.dumps(command, separators=(',', ':'))) for command in message['commands']]
+                self.assertTrue(sum(sizes) <= 4000)
+                body_size = len('{"commands":[]}') + sum(sizes) + len(sizes) - 1
+                self.assertEqual(compression if body_size >= 2000 else None, headers.get('Content-Encoding'))
+
+    def test_overflow_policies(self):
+        for overflow, expected in ((OVERFLOW_DROP_NEWEST, ['e0', 'e1', 'e2']),
+                                   (OVERFLOW_DROP_OLDEST, ['e2', 'e3', 'e4'])):
+            self.api.requests = []
+            transport = functools.partial(AsynchronousTransport, capacity=3, overflow=overflow)
+            infinario = Infinario('t', target=self.api.target, transport=transport)
+            for i in range(5):
+                infinario.track('e{0}'.format(i))
+            self.assertEqual(2, infinario._transport.dropped)
+            infinario.close()
+            infinario._transport.join()
+
+            self.assertEqual(expected, self._sent_event_types())
+
+    def test_buffer_max_bytes(self):
+        transport = functools.partial(AsynchronousTransport, buffer_max_bytes=2000, overflow=OVERFLOW_DROP_OLDEST)
+        infinario = Infinario('t', target=self.api.target, transport=transport)
+        self.addCleanup(infinario.close)
+        for i in range(20):
+            infinario.track('e{0}'.format(i), {'padding': 'x' * 200})
+        data = infinario._transport._worker_data
+        size = len(data.buffer[0].encoded)
+        self.assertTrue(2000 - size < data.buffered_bytes <= 2000)
+        kept = len(data.buffer)
+        self.assertEqual(20 - kept, infinario._transport.dropped)
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual(['e{0}'.format(i) for i in range(20 - kept, 20)], self._sent_event_types())
+
+    def _update_sequence(self, client):
+        client.update({'a': 1, 'b': 1})
+        client.track('e0')
+        client.customer('jane').update({'a': 2})
+        properties = {'b': 2}
+        client.update(properties)
+        client.update({'a': 3})
+        return properties
+
+    def _sent_commands(self):
+        return [(command['name'], command['data'].get('ids', command['data'].get('type')),
+                 command['data'].get('properties')) for service, message, _ in self.api.requests if service == 'bulk'
+                for command in message['commands']]
+
+    def test_coalesced_updates(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        infinario = Infinario('t', customer='joe', target=self.api.target, transport=functools.partial(
+            AsynchronousTransport, coalesce_updates=True, spool_dir=spool_dir))
+        properties = self._update_sequence(infinario)
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual([
+            ('crm/customers', {'registered': 'joe'}, {'a': 3, 'b': 2}),
+            ('crm/events', 'e0', {}),
+            ('crm/customers', {'registered': 'jane'}, {'a': 2}),
+        ], self._sent_commands())
+        self.assertEqual({'b': 2}, properties)
+        transport = AsynchronousTransport(self.api.target, None, spool_dir=spool_dir)
+        self.assertEqual(0, len(transport._worker_data.buffer))
+
+    def test_interactive_lane(self):
+        def respond(service, message):
+            if service == 'bulk':
+                time.sleep(1)
+            return StandInAPI.ok(service, message)
+        self.api.respond = respond
+
+        infinario = Infinario('t', customer='joe', target=self.api.target, secret='xyz',
+                              transport=functools.partial(AsynchronousTransport, prewarm=2))
+        infinario.prewarm(2)
+        infinario.track('e0')
+        infinario.flush()
+        time.sleep(0.1)
+        started = time.time()
+        self.assertEqual('<img />', infinario.get_html('Banner'))
+        self.assertLess(time.time() - started, 0.5)
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual(['HEAD'] * 4, [service for service, _, _ in self.api.requests if service == 'HEAD'])
+        self.assertTrue(all(headers['X-Infinario-Secret'] == 'xyz' for _, _, headers in self.api.requests))
+        transport = infinario._transport
+        self.assertIsNot(transport._interactive._session, transport._worker_data.transport._session)
+
+    def test_spool_replays_unacknowledged_commands(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+
+        # the API is unreachable, so nothing gets acknowledged before the transport goes away
+        infinario = Infinario('t', target='http://127.0.0.1:1/',
+                              transport=functools.partial(AsynchronousTransport, spool_dir=spool_dir))
+        for i in range(3):
+            infinario.track('e{0}'.format(i))
+        infinario.close()
+        infinario._transport.join()
+        self.assertEqual([], self.api.requests)
+
+        infinario = Infinario('t', target=self.api.target,
+                              transport=functools.partial(AsynchronousTransport, spool_dir=spool_dir))
+        infinario.track('e3')
+        infinario.close()
+        infinario._transport.join()
+        self.assertEqual(['e0', 'e1', 'e2', 'e3'], self._sent_event_types())
+
+        # everything was acknowledged, only the last (empty) active segment remains
+        self.assertEqual(1, len([name for name in os.listdir(spool_dir) if name.endswith('.log')]))
+        transport = AsynchronousTransport(self.api.target, None, spool_dir=spool_dir)
+        self.assertEqual(0, len(transport._worker_data.buffer))
+
+
+class TestMultipleProcesses(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI()
+        self.addCleanup(self.api.close)
+
+    def _sent_event_types(self):
+        return sorted(command['data']['type'] for service, message, _ in self.api.requests if service == 'bulk'
+                      for command in message['commands'])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_forked_child_starts_over(self):
+        infinario = Infinario('t', target=self.api.target, transport=AsynchronousTransport)
+        infinario.track('parent0')
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                infinario.track('child0')
+                infinario.close()
+                infinario._transport.join()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        infinario.track('parent1')
+        infinario.close()
+        infinario._transport.join()
+        self.assertEqual(['child0', 'parent0', 'parent1'], self._sent_event_types())
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_sidecar(self):
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir)
+        socket_path = os.path.join(socket_dir, 'sidecar.sock')
+
+        # the collector's transport may be wrapped, e.g. recorded
+        collector = SidecarCollector(self.api.target, socket_path, transport=functools.partial(
+            RecordingTransport, path=os.path.join(socket_dir, 'traffic.rec'),
+            transport=functools.partial(AsynchronousTransport, bulk_max_size=SIDECAR_BULK_SIZE)))
+        thread = threading.Thread(target=collector.serve_forever)
+        thread.start()
+        clients = [Infinario('t', target=self.api.target, metrics=Metrics(),
+                             transport=functools.partial(SidecarTransport, socket_path=socket_path)) for _ in range(3)]
+        for i, client in enumerate(clients):
+            for j in range(20):
+                client.track('e{0}-{1}'.format(i, j))
+        collector.stop()
+        thread.join()
+
+        self.assertEqual(sorted('e{0}-{1}'.format(i, j) for i in range(3) for j in range(20)), self._sent_event_types())
+        self.assertEqual(['bulk'], [service for service, _, _ in self.api.requests])
+        self.assertFalse(os.path.exists(socket_path))
+
+        # without a collector, commands are sent directly
+        clients[0].track('direct')
+        self.assertEqual('crm/events', self.api.requests[-1][0])
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_sidecar_socket_is_private(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+
+        with patch.dict(os.environ, {'XDG_RUNTIME_DIR': temp_dir}):
+            collector = SidecarCollector(self.api.target)
+            transport = SidecarTransport(self.api.target, MagicMock())
+        self.assertEqual(os.path.join(temp_dir, 'infinario-sidecar.sock'), transport._socket_path)
+        self.assertEqual(0o600, os.stat(transport._socket_path).st_mode & 0o777)
+        transport.stop()
+        collector.stop()
+        collector.serve_forever()
+
+        # without a runtime dir, the socket is in a private directory of the temp dir
+        with patch.dict(os.environ, {'XDG_RUNTIME_DIR': ''}), patch('tempfile.gettempdir', return_value=temp_dir):
+            transport = SidecarTransport(self.api.target, MagicMock())
+            self.assertEqual(0o700, os.stat(os.path.dirname(transport._socket_path)).st_mode & 0o777)
+            transport.stop()
+            os.chmod(os.path.dirname(transport._socket_path), 0o777)
+            self.assertRaises(ValueError, SidecarTransport, self.api.target, MagicMock())
+
+
+class TestAdaptiveBatching(unittest.TestCase):
+    def test_tuning(self):
+        batching = AdaptiveBatching(min_batch_size=10, max_batch_size=200, min_linger=0.01, max_linger=2)
+        self.assertEqual({'batch_size': 50, 'linger': 0.01, 'rtt': None}, batching.settings())
+
+        # backlog grows the bulks up to the bound
+        for _ in range(5):
+            batching.observe(0.1, 50, 0, 1000)
+        self.assertEqual(200, batching.batch_size)
+
+        # retries shrink the bulks and make commands wait longer
+        batching.observe(0.1, 200, 20, 1000)
+        self.assertEqual(100, batching.batch_size)
+        self.assertAlmostEqual(0.1, batching.linger)
+        batching.observe(None, 100, 100, 1000)
+        self.assertEqual(50, batching.batch_size)
+        self.assertAlmostEqual(0.2, batching.linger)
+
+        # without load, commands wait about half of the round-trip time
+        batching.observe(0.1, 5, 0, 0)
+        self.assertAlmostEqual(0.05, batching.linger)
+        for _ in range(50):
+            batching.observe(0.1, 5, 0, 0)
+        self.assertEqual(10, batching.batch_size)
+
+    def test_transport_with_adaptive_batching(self):
+        api = StandInAPI()
+        self.addCleanup(api.close)
+        transport = functools.partial(AsynchronousTransport, batching=AdaptiveBatching(max_linger=0.5))
+        infinario = Infinario('t', target=api.target, transport=transport)
+        for i in range(300):
+            infinario.track('e{0}'.format(i))
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual(300, sum(len(message['commands']) for _, message, _ in api.requests))
+        self.assertIsNotNone(infinario._transport.batching.settings()['rtt'])
+
+
+class TestRetries(unittest.TestCase):
+    def test_retry_policy(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=6, max_age=30)
+        for attempt, (low, high) in enumerate([(0.5, 1), (1, 2), (2, 4), (3, 6), (3, 6)], 1):
+            self.assertTrue(all(low <= policy.delay(attempt) <= high for _ in range(100)))
+        self.assertFalse(policy.exhausted(4, 29))
+        self.assertTrue(policy.exhausted(5, 0))
+        self.assertTrue(policy.exhausted(1, 31))
+
+    def test_circuit_breaker(self):
+        api = StandInAPI(lambda service, message: (503, {}))
+        self.addCleanup(api.close)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        transport = SynchronousTransport(api.target, Infinario('t', silent=False)._error_handler,
+                                         circuit_breaker=breaker)
+
+        for _ in range(4):
+            self.assertIsNone(transport.send_and_receive('crm/events', {}, no_raise=True))
+        self.assertTrue(breaker.open)
+        self.assertEqual(2, len(api.requests))
+        with self.assertRaisesRegex(ServiceUnavailable, 'unavailable'):
+            transport.send_and_receive('crm/events', {})
+
+        # after reset_timeout, a single trial request closes the circuit again
+        api.respond = StandInAPI.ok
+        time.sleep(0.2)
+        self.assertEqual({'success': True, 'data': '<img />'}, transport.send_and_receive('crm/events', {}))
+        self.assertFalse(breaker.open)
+        self.assertEqual(3, len(api.requests))
+
+    def test_asynchronous_transport_retries(self):
+        attempts = {}
+
+        def respond(service, message):
+            results = []
+            for command in message['commands']:
+                event_type = command['data']['type']
+                attempts[event_type] = attempts.get(event_type, 0) + 1
+                retry = event_type == 'never' or attempts[event_type] < 3
+                results.append({'status': 'retry' if retry else 'ok'})
+            return 200, {'success': True, 'results': results}
+
+        api = StandInAPI(respond)
+        self.addCleanup(api.close)
+        dead = []
+        policy = RetryPolicy(max_attempts=4, base_delay=0.01, dead_letter=lambda commands, reason, errors: dead.append(
+            ([command['data']['type'] for command in commands], reason)))
+        infinario = Infinario('t', target=api.target,
+                              transport=functools.partial(AsynchronousTransport, retry_policy=policy))
+        infinario.track('e0')
+        infinario.track('never')
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual({'e0': 3, 'never': 4}, attempts)
+        self.assertEqual([(['never'], 'retries exhausted')], dead)
+
+    def test_malformed_bulk_response(self):
+        responses = [{'success': True}, {'success': True, 'results': [{'status': 'retry'}]}]
+        api = StandInAPI(lambda service, message: (200, responses.pop(0)))
+        self.addCleanup(api.close)
+        logger = MagicMock()
+
+        def dead_letter(commands, reason, errors):
+            raise RuntimeError('dead letter failed')
+
+        policy = RetryPolicy(max_attempts=2, base_delay=0.01, dead_letter=dead_letter)
+        infinario = Infinario('t', target=api.target, logger=logger, transport=functools.partial(
+            AsynchronousTransport, capacity=100, retry_policy=policy))
+        infinario.track('e0')
+        infinario.flush()
+        time.sleep(0.1)
+
+        # the worker survived both responses and the dead letter handler
+        api.respond = StandInAPI.ok
+        for i in range(1, 150):
+            infinario.track('e{0}'.format(i))
+        infinario.close()
+        infinario._transport.join()
+
+        sent = [command['data']['type'] for _, message, _ in api.requests for command in message['commands']]
+        self.assertEqual(['e0', 'e0'] + ['e{0}'.format(i) for i in range(1, 150)], sent)
+        self.assertIn('dead letter handler failed', logger.error.call_args[0][0])
+
+    def test_retried_commands_keep_their_order(self):
+        received = []
+
+        def respond(service, message):
+            results = []
+            for command in message['commands']:
+                plan = command['data']['properties']['plan']
+                received.append(plan)
+                results.append({'status': 'retry' if received.count(plan) == 1 and plan == 'silver' else 'ok'})
+            return 200, {'success': True, 'results': results}
+
+        api = StandInAPI(respond)
+        self.addCleanup(api.close)
+        policy = RetryPolicy(base_delay=0.2)
+        infinario = Infinario('t', customer='joe', target=api.target,
+                              transport=functools.partial(AsynchronousTransport, retry_policy=policy))
+        infinario.update({'plan': 'silver'})
+        infinario.flush()
+        time.sleep(0.05)
+        infinario.update({'plan': 'gold'})
+        infinario.flush()
+        time.sleep(0.3)
+        infinario.close()
+        infinario._transport.join()
+
+        self.assertEqual(['silver', 'silver', 'gold'], received)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_client_and_transport_metrics(self):
+        api = StandInAPI()
+        self.addCleanup(api.close)
+        requests_seen = []
+        metrics = Metrics(on_request_start=lambda service, size: requests_seen.append(('start', service)),
+                          on_request_end=lambda service, status, seconds: requests_seen.append((status, service)))
+        infinario = Infinario('t', customer='joe', target=api.target, metrics=metrics,
+                              transport=functools.partial(AsynchronousTransport, capacity=10,
+                                                          overflow=OVERFLOW_DROP_NEWEST))
+        for i in range(12):
+            infinario.track('e{0}'.format(i))
+        infinario.update({'plan': 'gold'})
+        self.assertEqual(10, metrics.snapshot()['gauges']['buffer_depth'])
+        self.assertEqual('<img />', infinario.get_html('Banner'))
+        infinario.close()
+        infinario._transport.join()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual({
+            'events_tracked': 12, 'customers_updated': 1, 'commands_enqueued': 13, 'commands_dropped': 3,
+            'commands_sent': 10, 'commands_failed': 0, 'commands_retried': 0, 'requests': 2,
+        }, snapshot['counters'])
+        self.assertEqual(0, snapshot['gauges']['buffer_depth'])
+        self.assertEqual(1, snapshot['histograms']['get_html_seconds']['count'])
+        self.assertEqual((10, 1), snapshot['histograms']['bulk_count']['buckets'][3])
+        self.assertEqual(13, snapshot['histograms']['lock_wait_seconds']['buckets'][-1][1])
+        self.assertEqual([('start', 'campaigns/html/get'), (200, 'campaigns/html/get'),
+                          ('start', 'bulk'), (200, 'bulk')], requests_seen)
+
+
+class TestTrackingPolicy(unittest.TestCase):
+    def test_sampling_and_rate_limits(self):
+        policy = TrackingPolicy(sample_rates={'scroll': 0.1, 'purchase': 1}, rate_limits={'*': (10, 3)})
+        with patch('random.random', side_effect=[0.05, 0.5, 0.09, 0.99]):
+            self.assertEqual([True, False, True, False], [policy.allow('scroll') for _ in range(4)])
+        self.assertEqual([True] * 3 + [False] * 2, [policy.allow('purchase') for _ in range(5)])
+        self.assertTrue(policy.allow('view'))
+        time.sleep(0.15)
+        self.assertTrue(policy.allow('purchase'))
+        self.assertEqual({('scroll', 'sampled'): 2, ('purchase', 'rate_limited'): 2}, policy.dropped())
+
+    def test_shedding_by_priority(self):
+        transport = MagicMock(pressure=MagicMock(return_value=0.0))
+        policy = TrackingPolicy(priorities={'scroll': PRIORITY_LOW, 'purchase': PRIORITY_HIGH})
+        infinario = Infinario('t', metrics=Metrics(), policy=policy, transport=lambda *args, **kwargs: transport)
+        for pressure in (0.0, 0.5, 0.9, 1.0):
+            transport.pressure.return_value = pressure
+            for event_type in ('scroll', 'view', 'purchase'):
+                infinario.track(event_type)
+
+        self.assertEqual({('scroll', 'shed'): 3, ('view', 'shed'): 2}, policy.dropped())
+        self.assertEqual(5, infinario._metrics.snapshot()['counters']['events_dropped'])
+        self.assertEqual(['scroll', 'view', 'purchase', 'view', 'purchase', 'purchase', 'purchase'],
+                         [call[0][1]['type'] for call in transport.send_and_ignore.call_args_list])
+
+
+class TestRecordAndReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'traffic.rec')
+        self.recorded_api = StandInAPI()
+        self.addCleanup(self.recorded_api.close)
+        self.replayed_api = StandInAPI()
+        self.addCleanup(self.replayed_api.close)
+
+    def _record(self):
+        client = Infinario('t', customer='joe', target=self.recorded_api.target, transport=functools.partial(
+            RecordingTransport, path=self.path, chunk_size=100))
+        for i in range(5):
+            client.track('e{0}'.format(i))
+            time.sleep(0.05)
+        self.assertEqual('<img />', client.get_html('Banner'))
+        client.close()
+
+    def test_record_and_replay(self):
+        self._record()
+        client = Infinario('t', target=self.replayed_api.target)
+        started = time.time()
+        statistics = Replayer(client, speed=2, concurrency=2).run(self.path)
+
+        self.assertGreater(time.time() - started, 0.1)
+        self.assertEqual(6, statistics['calls'])
+        self.assertEqual(0, statistics['failed'])
+        self.assertGreater(statistics['latency_max'], 0)
+        self.assertEqual([(service, message) for service, message, _ in self.recorded_api.requests],
+                         [(service, message) for service, message, _ in self.replayed_api.requests])
+
+    @patch.object(requests, 'Session')
+    def test_recording_without_requests(self, session_mock):
+        self.recorded_api.respond = lambda service, message: (200, {'success': True, 'header': ['a'], 'rows': [[1]]})
+        client = Infinario('t', target=self.recorded_api.target, secret='xyz', transport=functools.partial(
+            RecordingTransport, path=self.path, transport=HTTPClientTransport))
+        self.assertEqual([['a'], [1]], list(client.export_rows('report', {})))
+        client.close()
+        self.assertFalse(session_mock.called)
+        self.assertEqual('xyz', self.recorded_api.requests[0][2]['X-Infinario-Secret'])
+
+        client = Infinario('t', target=self.replayed_api.target, transport=HTTPClientTransport)
+        self.addCleanup(client.close)
+        statistics = Replayer(client, speed=0).run(self.path)
+        self.assertEqual((1, 0), (statistics['calls'], statistics['failed']))
+        self.assertEqual([('analytics/report', {'format': 'table-json'})],
+                         [(service, message) for service, message, _ in self.replayed_api.requests])
+
+    def test_max_speed_with_async_transport(self):
+        self._record()
+        client = Infinario('t', target=self.replayed_api.target, transport=AsynchronousTransport)
+        self.addCleanup(client.close)
+        started = time.time()
+        statistics = Replayer(client, speed=0).run(self.path)
+
+        self.assertLess(time.time() - started, 0.2)
+        self.assertEqual(6, statistics['calls'])
+        client.close()
+        client._transport.join()
+        commands = [command['data']['type'] for service, message, _ in self.replayed_api.requests
+                    if service == 'bulk' for command in message['commands']]
+        self.assertEqual(['e{0}'.format(i) for i in range(5)], sorted(commands))
+
+
+class TestBulkImporter(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI(self._respond)
+        self.addCleanup(self.api.close)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.retried = set()
+
+    # every event with an even number gets the retry status once
+    def _respond(self, service, message):
+        results = []
+        for command in message['commands']:
+            number = int(command['data']['type'][1:])
+            if number % 2 == 0 and number not in self.retried:
+                self.retried.add(number)
+                results.append({'status': 'retry'})
+            else:
+                results.append({'status': 'ok'})
+        return 200, {'success': True, 'results': results}
+
+    def _imported_types(self):
+        return sorted(command['data']['type'] for _, message, _ in self.api.requests
+                      for command in message['commands'])
+
+    @patch('infinario.IMPORT_RETRY_DELAY', 0.01)
+    def test_import_with_retries_and_checkpoint(self):
+        client = Infinario('t', target=self.api.target, silent=False)
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        records = [{'customer': 'c{0}'.format(i), 'type': 'e{0}'.format(i), 'properties': {'i': i}}
+                   for i in range(250)]
+
+        importer = BulkImporter(client, connections=3, bulk_size=20, checkpoint=checkpoint)
+        statistics = importer.run(iter(records[:200]))
+        self.assertEqual((200, 200, 0), (statistics['records'], statistics['commands'], statistics['failed']))
+        self.assertEqual(sorted(['e{0}'.format(i) for i in list(range(200)) + list(range(0, 200, 2))]),
+                         self._imported_types())
+
+        self.api.requests = []
+        statistics = importer.run(iter(records))
+        self.assertEqual(250, statistics['records'])
+        self.assertEqual(sorted(['e{0}'.format(i) for i in list(range(200, 250)) + list(range(200, 250, 2))]),
+                         self._imported_types())
+
+    def test_csv_records(self):
+        path = os.path.join(self.directory, 'events.csv')
+        with open(path, 'w') as events:
+            events.write('customer,type,timestamp,product\njoe,e1,10.5,bottle\njohn,e3,,glass\n')
+
+        client = Infinario('t', target=self.api.target, silent=False)
+        BulkImporter(client).run(_read_import_records([path]))
+
+        commands = self.api.requests[0][1]['commands']
+        self.assertEqual([
+            {'name': 'crm/events', 'data': {'customer_ids': {'registered': 'joe'}, 'project_id': 't', 'type': 'e1',
+                                            'properties': {'product': 'bottle'}, 'timestamp': 10.5}},
+            {'name': 'crm/events', 'data': {'customer_ids': {'registered': 'john'}, 'project_id': 't', 'type': 'e3',
+                                            'properties': {'product': 'glass'}}},
+        ], commands)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio client requires Python 3.5+')
+class TestAsyncInfinario(unittest.TestCase):
+    def setUp(self):
+        self.api = StandInAPI()
+        self.addCleanup(self.api.close)
+
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    @staticmethod
+    async def _collect(iterator):
+        items = []
+        async for item in iterator:
+            items.append(item)
+        return items
+
+    def test_buffered_tracking_and_requests(self):
+        async def scenario():
+            async with AsyncInfinario('t', customer='joe', target=self.api.target, secret='xyz') as client:
+                await asyncio.gather(*[client.track('e{0}'.format(i)) for i in range(120)])
+                await client.update({'prop': 'val'})
+                html = await client.get_html('Banner')
+                segment = await client.get_segment('123-456')
+                await client.flush()
+                return html, segment
+
+        self.assertEqual(('<img />', 'Heavy payer'), self._run(scenario()))
+
+        services = [service for service, _, _ in self.api.requests]
+        self.assertEqual(1, services.count('campaigns/html/get'))
+        self.assertEqual(1, services.count('analytics/segmentation-for'))
+        commands = [command for service, message, _ in self.api.requests if service == 'bulk'
+                    for command in message['commands']]
+        self.assertEqual(['e{0}'.format(i) for i in range(120)],
+                         [c['data']['type'] for c in commands if c['name'] == 'crm/events'])
+        self.assertEqual([{'ids': {'registered': 'joe'}, 'project_id': 't', 'properties': {'prop': 'val'}}],
+                         [c['data'] for c in commands if c['name'] == 'crm/customers'])
+        self.assertTrue(all(headers['X-Infinario-Secret'] == 'xyz' for _, _, headers in self.api.requests))
+
+    def test_coalesced_updates(self):
+        async def scenario():
+            transport = functools.partial(AsyncioTransport, coalesce_updates=True)
+            async with AsyncInfinario('t', customer='joe', target=self.api.target, transport=transport) as client:
+                await client.update({'a': 1})
+                await client.update({'b': 2})
+                await client.track('e0')
+
+        self._run(scenario())
+        self.assertEqual([('crm/customers', {'a': 1, 'b': 2}), ('crm/events', {})],
+                         [(command['name'], command['data']['properties']) for service, message, _ in self.api.requests
+                          for command in message['commands']])
+
+    def test_retries(self):
+        def respond(service, message):
+            return 200, {'success': True, 'results': [
+                {'status': 'retry' if command['data']['type'] == 'never' else 'ok'} for command in message['commands']]}
+
+        self.api.respond = respond
+        dead = []
+        policy = RetryPolicy(max_attempts=3, base_delay=0.1, dead_letter=lambda commands, reason, errors: dead.append(
+            ([command['data']['type'] for command in commands], reason)))
+
+        async def scenario():
+            transport = functools.partial(AsyncioTransport, retry_policy=policy)
+            async with AsyncInfinario('t', customer='joe', target=self.api.target, transport=transport) as client:
+                await client.track('never')
+                await client.flush()
+                await client.track('e0')
+                await client.flush()
+
+        started = time.time()
+        self._run(scenario())
+        self.assertGreaterEqual(time.time() - started, 0.1)
+        self.assertEqual([['never'], ['never'], ['never'], ['e0']],
+                         [[command['data']['type'] for command in message['commands']]
+                          for _, message, _ in self.api.requests])
+        self.assertEqual([(['never'], 'retries exhausted')], dead)
+
+    def test_track_and_update_many(self):
+        self.api.respond = TestBatchCalls._respond
+
+        async def scenario():
+            async with AsyncInfinario('t', customer='joe', target=self.api.target) as client:
+                events = ({'type': 'e', 'properties': {'number': i}, 'customer': 'c{0}'.format(i)} for i in range(5))
+                tracked = client.track_many(events, bulk_size=3)
+                first = await tracked.__anext__()
+                requested = len(self.api.requests)
+                tracked = [first] + await self._collect(tracked)
+                updated = await self._collect(client.update_many([{'properties': {'number': 0}}, {'customer': 'c1'}]))
+                return requested, tracked, updated
+
+        requested, tracked, updated = self._run(scenario())
+        self.assertEqual(1, requested)
+        self.assertEqual(['ok', 'retry', 'ok', 'ok', 'retry'], [result.status for result in tracked])
+        self.assertEqual(['ok', 'invalid'], [result.status for result in updated])
+        self.assertEqual([3, 2, 1], [len(message['commands']) for _, message, _ in self.api.requests])
+        self.assertEqual({'registered': 'joe'}, self.api.requests[2][1]['commands'][0]['data']['ids'])
+
+    def test_streaming_export(self):
+        rows = TestStreamingExport.ROWS
+        self.api.respond = lambda service, message: (200, {
+            'success': True, 'header': ['customer', 'total', 'note'], 'rows': rows})
+
+        async def scenario():
+            async with AsyncInfinario('t', target=self.api.target, secret='s') as client:
+                exported = await self._collect(client.export_rows('report', {'analysis_id': 'a1'}))
+                batches = await self._collect(client.export_columns('report', {'analysis_id': 'a1'}, batch_size=300))
+                self.assertEqual(1, len(client._transport._pool._idle))
+                return exported, batches
+
+        exported, batches = self._run(scenario())
+        self.assertEqual([['customer', 'total', 'note']] + rows, exported)
+        self.assertEqual([300, 300, 300, 100], [len(batch['total']) for batch in batches])
+        self.assertEqual('table-json', self.api.requests[0][1]['format'])
+
+    def test_streamed_chunks(self):
+        body = u'customer,note\r\njoe,"multi\nline \u017elt\u00fd"\r\njane,x'.encode('utf-8')
+        pieces = [body[i:i + 3] for i in range(0, len(body), 3)]
+        encoded = b''.join(b'%x\r\n%s\r\n' % (len(piece), piece) for piece in pieces)
+
+        async def respond(reader, writer):
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + encoded + b'0\r\n\r\n')
+            await writer.drain()
+            writer.close()
+
+        async def scenario():
+            server = await asyncio.start_server(respond, '127.0.0.1', 0)
+            target = 'http://127.0.0.1:{0}/'.format(server.sockets[0].getsockname()[1])
+            try:
+                client = AsyncInfinario('t', target=target, silent=False, transport=functools.partial(
+                    AsyncioTransport, circuit_breaker=False))
+                exported = await self._collect(client.export_rows('report', {'format': 'csv'}))
+                await client.close()
+                return exported
+            finally:
+                server.close()
+
+        self.assertEqual([['customer', 'note'], ['joe', u'multi\nline \u017elt\u00fd'], ['jane', 'x']],
+                         self._run(scenario()))
+
+    def test_failed_export(self):
+        self.api.respond = lambda service, message: (200, {'success': False, 'errors': ['no such analysis']})
+
+        async def scenario():
+            async with AsyncInfinario('t', target=self.api.target, silent=False) as client:
+                with self.assertRaisesRegex(Exception, 'no such analysis'):
+                    await self._collect(client.export_rows('report', {}))
+
+        self._run(scenario())
+
+    def test_abandoned_exports_release_connections(self):
+        responses = [{'success': True, 'header': ['a'], 'rows': [[i] for i in range(10000)]}, [1], [2]]
+        self.api.respond = lambda service, message: (200, responses.pop(0) if service == 'analytics/report' else
+                                                     StandInAPI.ok(service, message)[1])
+
+        async def scenario():
+            transport = functools.partial(AsyncioTransport, pool_size=2)
+            async with AsyncInfinario('t', target=self.api.target, transport=transport) as client:
+                async with client.export_columns('report', {}, batch_size=10) as batches:
+                    async for _ in batches:
+                        break
+                for _ in range(2):
+                    with self.assertRaises(ValueError):
+                        await self._collect(client.export_rows('report', {}))
+                return await asyncio.wait_for(client.get_segment('s1'), 5)
+
+        self.assertEqual('Heavy payer', self._run(scenario()))
+
+    def test_unreachable_api(self):
+        logger = MagicMock()
+        CircuitBreaker.for_target('http://127.0.0.1:1/').reset()
+
+        async def scenario():
+            client = AsyncInfinario('t', customer='joe', target='http://127.0.0.1:1/', logger=logger)
+            await client.track('e0')
+            started = time.time()
+            await client.flush(timeout=0.3)
+            self.assertLess(time.time() - started, 1)
+            await client.close()
+
+        self._run(scenario())
+        self.assertIn('gave up on 1 commands', logger.error.call_args[0][0])
+
+    def test_flusher_survives_unexpected_responses(self):
+        self.api.respond = lambda service, message: (200, {'success': True})
+        logger = MagicMock()
+        policy = RetryPolicy(max_attempts=2, base_delay=0.01)
+
+        async def scenario():
+            transport = functools.partial(AsyncioTransport, retry_policy=policy)
+            async with AsyncInfinario('t', customer='joe', target=self.api.target, logger=logger,
+                                      transport=transport) as client:
+                await client.track('e0')
+                await client.flush()
+                self.api.respond = StandInAPI.ok
+                await client.track('e1')
+                await client.flush()
+
+        self._run(scenario())
+        self.assertEqual(['e0', 'e0', 'e1'], [command['data']['type'] for _, message, _ in self.api.requests
+                                              for command in message['commands']])
+        self.assertIn('gave up on 1 commands', logger.error.call_args[0][0])
+
+    def test_flush_waits_for_bulk_in_flight(self):
+        answered = []
+
+        def respond(service, message):
+            time.sleep(0.3)
+            answered.append(service)
+            return StandInAPI.ok(service, message)
+
+        self.api.respond = respond
+
+        async def scenario():
+            async with AsyncInfinario('t', customer='joe', target=self.api.target) as client:
+                await client.track('e0')
+                first = asyncio.ensure_future(client.flush())
+                await asyncio.sleep(0.1)
+                # the buffer is empty by now, the only command is being sent
+                await client.flush()
+                delivered = len(answered)
+                await first
+                return delivered
+
+        self.assertEqual(1, self._run(scenario()))
+
+    def test_get_segments(self):
+        self.api.respond = TestGetSegments._respond
+
+        async def scenario():
+            async with AsyncInfinario('t', target=self.api.target) as client:
+                segments = await client.get_segments('s1', ['joe', 'slow', 'joe', {'registered': 'jane'}], deadline=0.5)
+                # the request of the slow customer was cancelled and finished
+                self.assertEqual({asyncio.current_task()}, asyncio.all_tasks())
+                return segments
+
+        self.assertEqual({'joe': 'Segment of joe', 'slow': None, '{"registered": "jane"}': 'Segment of jane'},
+                         self._run(scenario()))
+        self.assertEqual(3, len(self.api.requests))
+
+    def test_error_semantics(self):
+        self.api.respond = lambda service, message: (400, {'success': False, 'errors': ['bad']})
+
+        async def scenario():
+            client = AsyncInfinario('t', target=self.api.target, silent=False,
+                                    transport=lambda target, errors, secret: AsyncioTransport(
+                                        target, errors, secret=secret, buffered=False))
+            with self.assertRaisesRegex(Exception, 'failed with errors'):
+                await client.track('e')
+            self.assertIsNone(await client.get_segment('123-456'))
+            await client.close()
+
+            CircuitBreaker.for_target('http://127.0.0.1:1/').reset()
+            client = AsyncInfinario('t', target='http://127.0.0.1:1/', silent=False)
+            with self.assertRaisesRegex(Exception, 'Failed connecting'):
+                await client.get_html('Banner')
+            await client.close()
+
+        self._run(scenario())